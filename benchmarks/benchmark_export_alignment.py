@@ -0,0 +1,51 @@
+#Benchmark: tile export throughput with native-aligned vs. unaligned Bio-Formats reads
+#Usage: python benchmarks/benchmark_export_alignment.py slide.vsi [series] [tileSize] [n_rows]
+#(series as in pyramid_sizes.csv; the exported tile rows go to a temporary scratch cube)
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main_functions import init_worker, get_reader, native_tile_size, reader_section
+from helperFunctions.scratch_cube import cube_layout, create_cube, open_plane
+
+image_path = sys.argv[1]
+series = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+tileSize = int(sys.argv[3]) if len(sys.argv) > 3 else 512
+n_rows = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+sizeC = 3 #for optical microscopy
+
+init_worker('4G')
+
+reader, _ = get_reader(image_path)
+reader.setSeries(series)
+sizeX = reader.getSizeX()
+sizeY = reader.getSizeY()
+nativeX, nativeY = native_tile_size(reader)
+
+y_list = list(range(min(n_rows, int(np.ceil(sizeY / tileSize)))))
+
+with tempfile.TemporaryDirectory() as folder:
+	layout = cube_layout(folder, series, sizeY, sizeX, sizeC, 1)
+	create_cube(layout)
+
+	#warm-up (file cache, reader state)
+	reader_section(image_path, series, 0, y_list[:1], tileSize, sizeC, folder, layout, False)
+
+	planes = {}
+	for align_native in [False, True]:
+		t0 = time.perf_counter()
+		values_unit = reader_section(image_path, series, 0, y_list, tileSize, sizeC, folder, layout, align_native)
+		t_export = time.perf_counter() - t0
+
+		n_bytes = sum([row[4]*row[5]*sizeC for row in values_unit])
+		planes[align_native] = np.array(open_plane(layout, 0)[:len(y_list)*tileSize])
+
+		print(f'series={series} {sizeX}x{sizeY} native={nativeX}x{nativeY} tileSize={tileSize} rows={len(y_list)} '
+			f'{"aligned  " if align_native else "unaligned"} {n_bytes/2**20:.0f} MB in {t_export:.2f} s ({n_bytes/2**20/t_export:.1f} MB/s)')
+
+	assert np.array_equal(planes[False], planes[True])
+	print('identical tiles')
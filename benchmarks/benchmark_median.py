@@ -0,0 +1,35 @@
+#Benchmark: median across angles (np.median on float32 vs. uint8 selection network)
+#Usage: python benchmarks/benchmark_median.py
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ray_tracing_module import median_planes, median_network
+
+tileSize = 512
+n_repeats = 3
+rng = np.random.default_rng(0)
+
+for n_layers in [6, 7, 18, 36]:
+	tile_temp = rng.integers(0, 256, size= (tileSize, tileSize, 3, n_layers), dtype= np.uint8)
+
+	#current (reference)
+	t0 = time.perf_counter()
+	for _ in range(n_repeats):
+		median_ref = np.median(tile_temp.astype(np.float32), axis= 3).astype(np.float32)
+	t_ref = (time.perf_counter() - t0)/n_repeats
+
+	#selection network
+	t0 = time.perf_counter()
+	for _ in range(n_repeats):
+		median_new = median_planes(np.moveaxis(tile_temp, 3, 0))
+	t_new = (time.perf_counter() - t0)/n_repeats
+
+	assert median_new.dtype == median_ref.dtype
+	assert np.array_equal(median_new, median_ref), n_layers
+
+	print(f'n_layers={n_layers:3d} comparators={len(median_network(n_layers)):4d} '
+		f'np.median={t_ref:.3f} s network={t_new:.3f} s speed-up={t_ref/t_new:.1f}x (identical)')
@@ -0,0 +1,58 @@
+#Benchmark: pyramidal OME-TIFF montage (pyvips tiffsave vs. parallel tifffile writer)
+#Usage: python benchmarks/benchmark_pyramid_writer.py [size] [n_workers]
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import pyvips
+import tifffile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from helperFunctions.pyramid_writer import write_pyramid, parallel_available
+
+size = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+n_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+tileSize = 512
+
+assert parallel_available(), 'requires tifffile and imagecodecs'
+
+#synthetic RGB montage (texture + gradient, compresses like a thin section)
+rng = np.random.default_rng(0)
+montage_np = (rng.integers(0, 40, size= (size, size + 537, 3)) + np.linspace(0, 200, size + 537)[None, :, None]).astype(np.uint8)
+montage = pyvips.Image.new_from_array(montage_np)
+
+#tall mono image as in ready_for_OME
+montage_roll = pyvips.Image.arrayjoin(montage.bandsplit(), across= 1).copy()
+montage_roll.set_type(pyvips.GValue.gint_type, "page-height", montage.height)
+montage_roll.set_type(pyvips.GValue.gstr_type, "image-description", '<OME/>')
+
+with tempfile.TemporaryDirectory() as folder:
+	for compression in ["lzw", "jpeg"]:
+		path_ref = os.path.join(folder, f"tiffsave_{compression}.tif")
+		path_new = os.path.join(folder, f"parallel_{compression}.tif")
+
+		#current (reference)
+		t0 = time.perf_counter()
+		montage_roll.tiffsave(path_ref, compression= compression, tile=True,
+					tile_width= tileSize, tile_height=tileSize,
+					pyramid=True, subifd=True, bigtiff=True)
+		t_ref = time.perf_counter() - t0
+
+		#parallel writer
+		t0 = time.perf_counter()
+		write_pyramid(montage_roll, path_new, tileSize, tileSize, compression, n_workers)
+		t_new = time.perf_counter() - t0
+
+		#same pyramid (levels, shapes, pixels)
+		with tifffile.TiffFile(path_ref) as tif_ref, tifffile.TiffFile(path_new) as tif_new:
+			levels_ref = tif_ref.series[0].levels
+			levels_new = tif_new.series[0].levels
+			assert len(levels_ref) == len(levels_new)
+			identical = all(np.array_equal(a.asarray(), b.asarray()) for a, b in zip(levels_ref, levels_new))
+
+		print(f'{compression:4s} {montage.width}x{montage.height}x3 levels={len(levels_new)} workers={n_workers} '
+			f'tiffsave={t_ref:.2f} s parallel={t_new:.2f} s speed-up={t_ref/t_new:.1f}x '
+			f'size={os.path.getsize(path_ref)/2**20:.0f}/{os.path.getsize(path_new)/2**20:.0f} MB '
+			f'({"identical" if identical else "different"} pixels)')
@@ -0,0 +1,48 @@
+#Benchmark: ray tracing statistics of one tile (whole angle stack vs. streaming accumulator)
+#Usage: python benchmarks/benchmark_statistics.py
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ray_tracing_module import calculate_statistics, StatisticAccumulator
+
+tileSize = 512
+n_repeats = 3
+statistic_list = ["max", "min", "mean", "median", "std", "maxIndex", "minIndex"]
+rng = np.random.default_rng(0)
+
+for dtype in [np.uint8, np.float32]:
+	for n_layers in [6, 18, 36]:
+		tile_temp = rng.integers(0, 256, size= (tileSize, tileSize, 3, n_layers)).astype(dtype)
+		tile_temp[:8, :8] = 7 #ties (first occurrence)
+
+		#reference (stacked angles)
+		t0 = time.perf_counter()
+		for _ in range(n_repeats):
+			statistics_ref = calculate_statistics(tile_temp, statistic_list)
+		t_ref = (time.perf_counter() - t0)/n_repeats
+
+		#accumulator (one angle at a time)
+		t0 = time.perf_counter()
+		for _ in range(n_repeats):
+			accumulator = StatisticAccumulator(statistic_list, n_layers)
+			for i in range(n_layers):
+				accumulator.update(tile_temp[:, :, :, i])
+			statistics_new = accumulator.result()
+		t_new = (time.perf_counter() - t0)/n_repeats
+
+		for sel_stats in statistic_list:
+			value_ref = statistics_ref[sel_stats]
+			value_new = statistics_new[sel_stats]
+			assert value_new.dtype == value_ref.dtype, sel_stats
+			if sel_stats in ["mean", "std"]: #Welford (float64) vs. float32 sums
+				assert np.allclose(value_new, value_ref, atol= 1e-3), sel_stats
+			else:
+				assert np.array_equal(value_new, value_ref), sel_stats
+
+		#the accumulator trades time for memory (no stack of n_layers angle tiles)
+		print(f'{np.dtype(dtype).name:7s} n_layers={n_layers:3d} stack={t_ref:.3f} s '
+			f'accumulator={t_new:.3f} s ratio={t_ref/t_new:.1f}x stack memory={tile_temp.nbytes/2**20:.0f} MB (same statistics)')
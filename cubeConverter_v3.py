@@ -380,6 +380,12 @@ class Ui_MainWindow(object):
         self.label_12.setWordWrap(True)
         self.label_12.setObjectName("label_12")
         self.horizontalLayout_7.addWidget(self.label_12)
+        self.pushButton_9 = QtWidgets.QPushButton(self.frame)
+        font = QtGui.QFont()
+        font.setPointSize(10)
+        self.pushButton_9.setFont(font)
+        self.pushButton_9.setObjectName("pushButton_9")
+        self.horizontalLayout_7.addWidget(self.pushButton_9)
         self.verticalLayout_5.addLayout(self.horizontalLayout_7)
         self.horizontalLayout_8 = QtWidgets.QHBoxLayout()
         self.horizontalLayout_8.setObjectName("horizontalLayout_8")
@@ -734,7 +740,9 @@ class Ui_MainWindow(object):
         self.checkBox_11.setText(_translate("MainWindow", "Median"))
         self.checkBox_9.setText(_translate("MainWindow", "Standard deviation"))
         self.label_11.setText(_translate("MainWindow", "Brightness capping"))
-        self.label_12.setText(_translate("MainWindow", "% percentile adjustment (for index, std)"))
+        self.label_12.setText(_translate("MainWindow", "% percentile adjustment (for std)"))
+        self.pushButton_9.setToolTip(_translate("MainWindow", "Re-render std montages with the new percentile (no ray tracing)"))
+        self.pushButton_9.setText(_translate("MainWindow", "Re-contrast"))
         self.label_9.setText(_translate("MainWindow", "Parallel processing"))
         self.label_17.setText(_translate("MainWindow", "threads"))
         self.pushButton_7.setText(_translate("MainWindow", "Run"))
@@ -0,0 +1,139 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import tifffile
+    import imagecodecs #lzw/jpeg encoders used by tifffile
+except ImportError:
+    tifffile = None
+
+
+#Parallel pyramidal OME-TIFF writer (same layout as pyvips tiffsave with page-height, pyramid=True,
+#subifd=True, bigtiff=True): one page per channel, reduced levels as SubIFDs, OME-XML in page 0.
+#Level-0 strips come from libvips (prefetched in a thread) or any strip reader (e.g. Bio-Formats)
+#while tifffile compresses tiles in parallel threads; the 2x2 mean levels are built from the
+#strips into memory-mapped scratch.
+
+def parallel_available():
+
+    return tifffile is not None
+
+def pyramid_sizes(width, height, tileSizeX, tileSizeY):
+    #Level sizes as libvips: halve (floor) until the level fits in one tile
+    sizes = [(width, height)]
+    while (width > tileSizeX) or (height > tileSizeY):
+        width = max(1, width // 2)
+        height = max(1, height // 2)
+        sizes.append((width, height))
+
+    return sizes
+
+def shrink2(strip):
+    #2x2 mean rounded half up (libvips 'mean' region shrink), odd rows/columns dropped
+    h = strip.shape[-2] // 2 * 2
+    w = strip.shape[-1] // 2 * 2
+
+    total = strip[..., 0:h:2, 0:w:2].astype(np.uint32)
+    total += strip[..., 1:h:2, 0:w:2]
+    total += strip[..., 0:h:2, 1:w:2]
+    total += strip[..., 1:h:2, 1:w:2]
+
+    return ((total + 2) // 4).astype(strip.dtype)
+
+def iter_tiles(strips, tileSizeX, tileSizeY):
+    #Tiles (row-major, zero padded) of consecutive (rows, width) strips
+    for strip in strips:
+        padded = np.zeros((tileSizeY, strip.shape[1] + (-strip.shape[1]) % tileSizeX), dtype= strip.dtype)
+        padded[:strip.shape[0], :strip.shape[1]] = strip
+
+        for x0 in range(0, padded.shape[1], tileSizeX):
+            yield padded[:, x0:x0 + tileSizeX]
+
+def write_pyramid(montage_roll, output_path, tileSizeX, tileSizeY, compression, n_workers):
+    #montage_roll: tall mono image of ready_for_OME (page-height, image-description)
+
+    height = montage_roll.get("page-height")
+    shape = (montage_roll.height // height, height, montage_roll.width)
+    dtype = np.dtype({'uchar': np.uint8, 'ushort': np.uint16}[montage_roll.format])
+
+    def read_strip(page, y0, rows):
+        #evaluated by libvips (its own threads) outside the GIL
+        return montage_roll.crop(0, page * height + y0, shape[2], rows).numpy().reshape(rows, shape[2])
+
+    write_pyramid_strips(read_strip, shape, dtype, output_path, tileSizeX, tileSizeY, compression, n_workers,
+                         montage_roll.get("image-description"), (montage_roll.xres, montage_roll.yres))
+
+def write_pyramid_strips(read_strip, shape, dtype, output_path, tileSizeX, tileSizeY, compression, n_workers,
+                         description=None, resolution=(1.0, 1.0), prefetch=True):
+    #read_strip(page, y0, rows): (rows, width) array, called in page and row order
+    #shape: (pages, height, width); resolution: pixels/mm (as libvips)
+    #prefetch: next strip read in a helper thread (False for sources bound to one thread, e.g. Bio-Formats)
+
+    n_pages, height, width = shape
+    sizes = pyramid_sizes(width, height, tileSizeX, tileSizeY)
+
+    options = dict(
+        tile= (tileSizeY, tileSizeX),
+        photometric= 'minisblack',
+        compression= compression,
+        compressionargs= {'level': 75} if compression == 'jpeg' else None, #tiffsave Q
+        predictor= compression != 'jpeg', #horizontal (as tiffsave)
+        resolution= (resolution[0] * 25.4, resolution[1] * 25.4), #pixels/mm to dpi
+        resolutionunit= 'INCH',
+        metadata= None, #OME-XML from ready_for_OME
+        maxworkers= n_workers,
+        )
+
+    #Scratch for the reduced levels (removed afterwards)
+    level_paths = [f"{output_path}.level{k}.tmp" for k in range(1, len(sizes))]
+    levels = [np.memmap(path, dtype= dtype, mode= 'w+', shape= (n_pages, size[1], size[0]))
+              for path, size in zip(level_paths, sizes[1:])]
+
+    def strips():
+        jobs = [(page, y0, min(tileSizeY, height - y0)) for page in range(n_pages) for y0 in range(0, height, tileSizeY)]
+
+        if not prefetch:
+            yield from (job + (read_strip(*job),) for job in jobs)
+            return
+
+        with ThreadPoolExecutor(1) as executor: #next strip read while tiles are compressed
+            future = executor.submit(read_strip, *jobs[0])
+            for i, job in enumerate(jobs):
+                strip = future.result()
+                if i + 1 < len(jobs):
+                    future = executor.submit(read_strip, *jobs[i + 1])
+
+                yield job + (strip,)
+
+    def level0_strips():
+        for page, y0, rows, strip in strips():
+
+            if levels: #tile heights are even, so strips start on even rows
+                reduced = shrink2(strip)
+                rows = min(reduced.shape[0], sizes[1][1] - y0 // 2)
+                levels[0][page, y0 // 2:y0 // 2 + rows] = reduced[:rows, :sizes[1][0]]
+
+            yield strip
+
+    try:
+        with tifffile.TiffWriter(output_path, bigtiff= True) as tif:
+            tif.write(iter_tiles(level0_strips(), tileSizeX, tileSizeY), shape= shape, dtype= dtype,
+                      subifds= len(levels), description= description, **options)
+
+            for k, level in enumerate(levels):
+                level.flush()
+
+                if k + 1 < len(levels): #next level, in row blocks (bounded memory)
+                    size_next = sizes[k + 2]
+                    for y0 in range(0, size_next[1], 1024):
+                        rows = min(1024, size_next[1] - y0)
+                        block = level[:, 2 * y0:2 * (y0 + rows), :2 * size_next[0]]
+                        levels[k + 1][:, y0:y0 + rows] = shrink2(block)
+
+                tif.write(level, subfiletype= 1, **options)
+
+    finally:
+        for level, path in zip(levels, level_paths):
+            level._mmap.close()
+            os.remove(path)
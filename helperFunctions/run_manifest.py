@@ -0,0 +1,118 @@
+import os
+import json
+import hashlib
+
+
+#Fingerprints
+def fingerprint(*items):
+    #Short hash of any JSON-serialisable inputs
+    text = json.dumps(items, sort_keys=True, default=str)
+
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+def file_fingerprint(path):
+    stat1 = os.stat(path)
+
+    return fingerprint(os.path.abspath(path), stat1.st_size, stat1.st_mtime_ns)
+
+def export_fingerprint(data):
+    #Export tiles depend on the input file, pyramid level, tile size and format (experimental_metadata.json)
+    items = [file_fingerprint(data["image_path"]), data["sel_level"], data["tileSizeX"], data["tileSizeY"]]
+
+    export_format = data.get("export_format", "tiles")
+    if export_format != "tiles": #earlier runs stay valid
+        items.append(export_format)
+
+    return fingerprint(*items)
+
+
+#Run manifest
+class RunManifest:
+    #Append-only record of completed work (export tiles, statistic tiles, montages).
+    #One JSON line per completion, so a crash keeps everything flushed before it.
+    #One append handle per phase (flush per batch, close at the end); duplicate keys
+    #of earlier runs are compacted to the latest entry when the manifest is loaded.
+
+    def __init__(self, workingDir):
+        self.path = os.path.join(workingDir, 'run_manifest.jsonl')
+        self.entries = {}
+        self.file = None
+
+        n_lines = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    n_lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError: #partial line (interrupted write)
+                        continue
+                    self.entries[entry["key"]] = entry #latest wins
+
+        if n_lines > len(self.entries):
+            self.compact()
+
+    def compact(self):
+        #Latest entry per key (atomic replace)
+        path_tmp = self.path + ".tmp"
+        with open(path_tmp, 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry, default=int) + "\n")
+
+        os.replace(path_tmp, self.path)
+
+    def drop_missing(self, prefix, path_index):
+        #Forget entries (key prefix) whose recorded outputs were deleted (e.g. scratch freed),
+        #so they are dispatched again; call before recreating output folders or containers
+        exists = {} #one check per tile file or container
+        keys_missing = []
+        for key, entry in self.entries.items():
+            if not key.startswith(prefix) or not entry["rows"]:
+                continue
+
+            for row in entry["rows"]:
+                path = row[path_index]
+                if path not in exists:
+                    exists[path] = os.path.exists(path)
+                if not exists[path]:
+                    keys_missing.append(key)
+                    break
+
+        for key in keys_missing:
+            del self.entries[key]
+
+        if keys_missing:
+            print(f"Redoing {len(keys_missing)} completed units ({prefix}) with missing outputs")
+
+        return keys_missing
+
+    def is_done(self, key, fingerprint):
+        entry = self.entries.get(key)
+
+        return (entry is not None) and (entry["fingerprint"] == fingerprint)
+
+    def mark_done(self, key, fingerprint, rows=None):
+        #Buffered until flush()/close()
+        entry = {"key": key, "fingerprint": fingerprint, "rows": rows}
+        self.entries[key] = entry
+
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        self.file.write(json.dumps(entry, default=int) + "\n")
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def rows(self, keys):
+        #Table rows recorded for the given keys (in order)
+        values = []
+        for key in keys:
+            values.extend(self.entries[key]["rows"])
+
+        return values
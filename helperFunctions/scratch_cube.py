@@ -0,0 +1,50 @@
+import os
+import numpy as np
+
+
+#Scratch cube: one preallocated raw file per exported series, its z planes (Y, X, C) back to back.
+#Replaces thousands of small tile TIFFs (one file, no per-tile metadata operations).
+#The same containers hold ray tracing statistics (one per modality, statistic and z plane).
+
+def cube_layout(folder, series, sizeY, sizeX, sizeC, image_count, dtype="uint8"):
+    #Recorded in 'experimental_metadata.json' (readers need nothing else)
+
+    return raw_layout(os.path.join(folder, f"series{series}.raw"), sizeY, sizeX, sizeC, image_count, dtype)
+
+def raw_layout(path, sizeY, sizeX, sizeC, image_count=1, dtype="uint8"):
+    #Any raw container of (Y, X, C) planes (e.g. ray tracing statistics)
+    plane_bytes = sizeY * sizeX * sizeC * np.dtype(dtype).itemsize
+
+    layout = {
+        "path": path,
+        "shape": [sizeY, sizeX, sizeC],
+        "dtype": dtype,
+        "offsets": [z * plane_bytes for z in range(image_count)], #bytes, per z plane
+        }
+
+    return layout
+
+def cube_bytes(layout):
+    shape = layout["shape"]
+
+    return layout["offsets"][-1] + shape[0] * shape[1] * shape[2] * np.dtype(layout["dtype"]).itemsize
+
+def create_cube(layout):
+    #Preallocated once (sparse where the file system allows); kept when resuming
+    size = cube_bytes(layout)
+
+    if os.path.exists(layout["path"]) and (os.path.getsize(layout["path"]) == size):
+        return
+
+    with open(layout["path"], 'wb') as f:
+        f.truncate(size)
+
+def open_plane(layout, z, mode='r'):
+    #Memory-mapped (Y, X, C) plane: slices are zero-copy views
+
+    return np.memmap(layout["path"], dtype= layout["dtype"], mode= mode,
+                     offset= layout["offsets"][z], shape= tuple(layout["shape"]))
+
+def read_region(layout, z, left, top, width, height):
+
+    return open_plane(layout, z)[top:top + height, left:left + width]
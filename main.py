@@ -65,12 +65,36 @@ class Window(QMainWindow, Ui_MainWindow):
 		self.items_output = ['reflected', 'ppl', 'xpl', 'rayTracing']  #update manually
 		self.items_rt = ['ppl', 'xpl']
 		self.items_calculation = ['max','maxIndex']
+		#Bio-Formats memo files (None= disabled)
+		self.memo_dir = os.path.join(os.path.expanduser("~"), ".cube_converter", "bfmemo")
+		#Resume from 'run_manifest.jsonl' (False= delete the processed folder first)
+		self.resume_run = True
+		#Ray tracing engine ('numpy'= statistic tiles, 'vips'= lazy whole-montage graph)
+		self.rt_engine = "numpy"
+		#Export ('tiles'= one TIFF per tile, 'cube'= one memory-mapped scratch file per series)
+		self.export_format = "tiles"
+		#Bio-Formats reads aligned to the native (ETS) tile grid, cut into tileSize tiles (False= one read per tile)
+		self.align_native = True
+		#Statistic tiles ('compact'= uint8/uint16, 'float32') and their compression (None, 'lzw', 'deflate')
+		self.rt_encoding = "compact"
+		self.rt_compression = None
+		#Originals read by Bio-Formats straight into their pyramids (False= 'bf_tiles' export and join)
+		self.transcode_originals = False
+		#Statistic output ('tiles'= one TIFF per tile, 'cube'= one raw container per modality, statistic and z)
+		self.rt_format = "tiles"
+		#One multi-channel OME-TIFF per modality and z with all statistics (False= one file per statistic)
+		self.rt_pack = False
+		#Montage pyramids ('parallel'= tiles compressed on n_cores threads, 'vips'= libvips tiffsave)
+		self.pyramid_writer = "parallel"
 		#widget list
 		self.list_widget = []
+		#worker pool (JVM-backed, reused by every run in the session)
+		self.pool = None
 
 		#Define functionality     
 		self.pushButton_2.clicked.connect(self.open_file_dialog) #left  
 		self.pushButton_7.clicked.connect(self.runningFunction) 		 
+		self.pushButton_9.clicked.connect(self.recontrastFunction)
 
 		self.pushButton_5.clicked.connect(self.open_folder_dialog) #right 
 		self.pushButton_8.clicked.connect(self.runningFunction2) 		
@@ -137,6 +161,27 @@ class Window(QMainWindow, Ui_MainWindow):
 
 	#endregion 
 
+	#region Worker pool
+
+	def get_pool(self, n_cores):
+		#Reuse the running pool unless the user changed the number of cores
+		if (self.pool is not None) and (self.pool.n_cores != n_cores):
+			self.shutdown_pool()
+
+		if self.pool is None:
+			if self.memo_dir is not None:
+				make_dir(self.memo_dir)
+			self.pool = WorkerPool(n_cores, self.assigned_RAM, self.memo_dir)
+
+		return self.pool
+
+	def shutdown_pool(self):
+		if self.pool is not None:
+			self.pool.close()
+			self.pool = None
+
+	#endregion
+
 	#region Left GUI functions
 	def open_file_dialog(self):
 		file_path, _ = QFileDialog.getOpenFileName(
@@ -254,7 +299,10 @@ class Window(QMainWindow, Ui_MainWindow):
 		dirname1 = os.path.dirname(image_path)
 		basename1 = os.path.basename(image_path).replace(".vsi", "")
 		workingDir1 = os.path.join(dirname1, "processed_" + basename1)
-		mkdir1(workingDir1) #remover= mkdir1, keeper= mkdir2          
+		if self.resume_run:
+			mkdir2(workingDir1) #only missing or stale work is redone
+		else:
+			mkdir1(workingDir1) #remover= mkdir1, keeper= mkdir2          
 		
 		#Output convention
 		condition1 = "originals" in items_output
@@ -266,22 +314,63 @@ class Window(QMainWindow, Ui_MainWindow):
 
 		modality_logical = [ any([item.find(str) != -1 for item in items_output]) for str in modality_list ] #ppl, xpl
 
+		pyramid_workers = n_cores if self.pyramid_writer == "parallel" else None
+
 		#Main_script   
-		assigned_RAM = self.assigned_RAM                 
-		read_metadata_function(image_path, assigned_RAM)    
+		pool = self.get_pool(n_cores)
+		read_metadata_function(image_path, pool)    
+
+		#Originals streamed into their pyramids (no 'bf_tiles' export)
+		if self.transcode_originals and (condition1 or condition2 or condition3 or condition4):
+			transcode_original_function(image_path, sel_level, tileSize, pool, conditions, pyramid_workers)
+			if not condition5:
+				return
+			condition1 = condition2 = condition3 = condition4 = False #ray tracing as in ray-tracing-only runs
+
+		#Ray-tracing-only run (tile-major, no 'bf_tiles' export)
+		if condition5 and not (condition1 or condition2 or condition3 or condition4):
+			if self.rt_engine == "vips":
+				conditions_rt = [False, "ppl" in modality_list, "xpl" in modality_list, False, True]
+				save_tiles_function(image_path, sel_level, tileSize, pool, conditions_rt, self.export_format, self.align_native)
+				pool.apply(ray_tracing_vips_function, (workingDir1, modality_list, statistic_list, percentOut_dsaImage, self.rt_pack, pyramid_workers))
+			else:
+				ray_tracing_direct_function(image_path, sel_level, tileSize, modality_list, statistic_list, pool, self.rt_encoding, self.rt_compression, self.rt_format)
+				join_rt_tiles_function(workingDir1, statistic_list, percentOut_dsaImage, pool, self.rt_encoding, self.rt_pack, pyramid_workers, self.rt_format)
+			return
 				
-		save_tiles_function(image_path, sel_level, tileSize, n_cores, assigned_RAM, conditions)          
+		save_tiles_function(image_path, sel_level, tileSize, pool, conditions, self.export_format, self.align_native)          
 		
 		if condition1 or condition2 or condition3 or condition4:                
-			join_original_tiles_function(workingDir1, conditions)   
+			join_original_tiles_function(workingDir1, conditions, pool, pyramid_workers)
 
 		if (condition1 or condition2 or condition3) and condition5 and all(modality_logical):
-			ray_tracing_function(workingDir1, modality_list, statistic_list, n_cores)     
-			join_rt_tiles_function(workingDir1, statistic_list, percentOut_dsaImage)  
+			if self.rt_engine == "vips":
+				pool.apply(ray_tracing_vips_function, (workingDir1, modality_list, statistic_list, percentOut_dsaImage, self.rt_pack, pyramid_workers))
+			else:
+				ray_tracing_function(workingDir1, modality_list, statistic_list, pool, self.rt_encoding, self.rt_compression, self.rt_format)     
+				join_rt_tiles_function(workingDir1, statistic_list, percentOut_dsaImage, pool, self.rt_encoding, self.rt_pack, pyramid_workers, self.rt_format)
 		elif not all(modality_logical):
 			modality_logical_not = [not elem for elem in modality_logical]
 			print(f"Error: {list(compress(modality_list, modality_logical_not))} needs to be included in the initial export.")    
 
+	def recontrastFunction(self):
+		#New percentile for std montages (reuses the statistics of the last run; indexes use a fixed mapping)
+
+		#User input
+		image_path = self.lineEdit.text()
+		percentOut_dsaImage = self.doubleSpinBox.value()        
+		n_cores = self.spinBox_2.value()
+
+		#Folder convention
+		dirname1 = os.path.dirname(image_path)
+		basename1 = os.path.basename(image_path).replace(".vsi", "")
+		workingDir1 = os.path.join(dirname1, "processed_" + basename1)
+
+		pyramid_workers = n_cores if self.pyramid_writer == "parallel" else None
+
+		pool = self.get_pool(n_cores)
+		pool.apply(recontrast_rt_function, (workingDir1, percentOut_dsaImage, pyramid_workers, self.rt_pack))
+
 	def runningFunction2(self):  
 		
 		def qListWidget_list(list_widget):
@@ -297,6 +386,7 @@ class Window(QMainWindow, Ui_MainWindow):
 		
 		pixel_size_sel = float(self.lineEdit_3.text())
 		tileSize = int(self.comboBox_2.currentText())
+		n_cores = self.spinBox_2.value()
 		filename_output = self.lineEdit_2.text()
 		output_folder = self.output_folder
 		
@@ -305,7 +395,10 @@ class Window(QMainWindow, Ui_MainWindow):
 		file_output = filename_output + ".tif" 
 		output_path = os.path.join(output_folder, file_output)  
 
-		zStack_montages(fileList2, pixel_size_sel, tileSize, output_path)		
+		pyramid_workers = n_cores if self.pyramid_writer == "parallel" else None
+
+		pool = self.get_pool(n_cores)
+		pool.apply(zStack_montages, (fileList2, pixel_size_sel, tileSize, output_path, pyramid_workers))		
 
 	#endregion	
 
@@ -341,8 +434,8 @@ if __name__ == "__main__":
 	from itertools import compress
 
 	#relative to script path	
-	from helperFunctions.mkdir_options import mkdir1, mkdir2 
-	from main_functions import read_metadata_function, save_tiles_function, ray_tracing_function, join_rt_tiles_function, join_original_tiles_function, parse_system_info, zStack_montages
+	from helperFunctions.mkdir_options import mkdir1, mkdir2, make_dir 
+	from main_functions import read_metadata_function, save_tiles_function, ray_tracing_function, ray_tracing_direct_function, ray_tracing_vips_function, join_rt_tiles_function, recontrast_rt_function, join_original_tiles_function, transcode_original_function, parse_system_info, zStack_montages, WorkerPool
 	
 	#GUI
 	from PyQt5.QtWidgets import QApplication, QFileDialog
@@ -354,6 +447,7 @@ if __name__ == "__main__":
 	#Run
 	app = QApplication(sys.argv)
 	window = Window()
+	app.aboutToQuit.connect(window.shutdown_pool) #clean pool shutdown
 	window.show()
 	sys.exit(app.exec_())
 
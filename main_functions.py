@@ -17,17 +17,20 @@ https://superfastpython.com/multiprocessing-pool-initializer/
 #Basic
 import os
 import sys
-import glob
-import re
 import psutil
 
 import math
+import contextlib
+import time
 import numpy as np
 import pandas as pd
 import json
+import pickle
+import hashlib
 
 from itertools import compress
 import multiprocessing
+import multiprocessing.util
 
 #Write ome
 import uuid
@@ -39,7 +42,6 @@ from ome_types.model import TiffData
 
 #Javabridge
 import javabridge 
-import atexit
 #Note: to avoid console print issue, I modified javabridge/locate.py --> find_javahome()
 
 #Bioformats
@@ -48,8 +50,12 @@ import bioformats.formatreader as F
 from bioformats import metadatatools
 
 #relative to script path
-from helperFunctions.mkdir_options import mkdir2 
-from ray_tracing_module import calculate_statistic, understand_tiling, img_rescaled, channel_uint8
+from helperFunctions.mkdir_options import mkdir2, remove
+from helperFunctions.run_manifest import RunManifest, fingerprint, export_fingerprint
+from helperFunctions.scratch_cube import cube_layout, raw_layout, create_cube, open_plane, read_region
+from helperFunctions.pyramid_writer import write_pyramid, write_pyramid_strips, parallel_available
+from ray_tracing_module import StatisticAccumulator, encode_statistic, vips_statistics, save_tiling, load_tiling, tile_grid, img_rescaled, img_rescaled_hist, channel_uint8, index_step
+from ray_tracing_module import tile_histograms, merge_histograms, montage_histogram, load_histograms, save_histograms, statistic_formats
 
 #VIPS
 add_dll_dir = getattr(os, 'add_dll_directory', None) #Windows=True
@@ -107,7 +113,7 @@ def get_size(bytes, suffix=""): #suffix="B"
 			return return1, return2 #bytes:.2f
 		bytes /= factor
 
-def init_worker(assigned_RAM):	
+def init_worker(assigned_RAM, memo_dir=None):	
 	
 	#BioFormats path list
 	if getattr(sys, 'frozen', False):	# Running in a PyInstaller bundle
@@ -135,6 +141,172 @@ def init_worker(assigned_RAM):
 	rootLogger = javabridge.static_call("org/slf4j/LoggerFactory","getLogger", "(Ljava/lang/String;)Lorg/slf4j/Logger;", rootLoggerName)
 	logLevel = javabridge.get_static_field("ch/qos/logback/classic/Level",myloglevel, "Lch/qos/logback/classic/Level;")
 	javabridge.call(rootLogger, "setLevel", "(Lch/qos/logback/classic/Level;)V", logLevel)
+
+	#Bio-Formats Memoizer cache (None= disabled)
+	global _memo_dir
+	_memo_dir = memo_dir
+
+	#Runs when the worker leaves the pool (close/join), not after every task
+	multiprocessing.util.Finalize(None, shutdown_worker, exitpriority=10)
+
+def shutdown_worker():
+
+	close_readers()
+	javabridge.kill_vm()
+
+#Per-worker reader handles (key= path, size, mtime), so later tasks only call setSeries
+_reader_cache = {}
+_memo_dir = None
+
+def make_memoizer_class():
+	#loci.formats.Memoizer saves the initialised reader state (.bfmemo) for warm runs
+	IFormatReader = F.make_iformat_reader_class()
+
+	class Memoizer(IFormatReader):
+		new_fn = javabridge.make_new('loci/formats/Memoizer', '(Lloci/formats/IFormatReader;JLjava/io/File;)V')
+		def __init__(self, rdr, directory):
+			directory_file = javabridge.make_instance('java/io/File', '(Ljava/lang/String;)V', directory)
+			self.new_fn(rdr.o, 0, directory_file) #minimumElapsed= 0 ms (always memoize)
+	
+	return Memoizer
+
+def memo_cache_dir(memo_dir, image_path):
+	#Memo folder per input file and fingerprint (size, mtime): edited files miss the cache
+	image_path2 = os.path.abspath(image_path)
+	stat1 = os.stat(image_path2)
+	
+	path_key = hashlib.sha1(image_path2.encode("utf-8")).hexdigest()[:16]
+	fingerprint = f"{stat1.st_size}_{stat1.st_mtime_ns}"
+
+	return os.path.join(memo_dir, path_key, fingerprint)
+
+def prune_memo_cache(memo_dir, image_path):
+	#Delete memos of older versions of the same file (run before dispatching work)
+	cache_dir = memo_cache_dir(memo_dir, image_path)
+	parent_dir = os.path.dirname(cache_dir)
+	
+	if os.path.isdir(parent_dir):
+		for item in os.listdir(parent_dir):
+			path_temp = os.path.join(parent_dir, item)
+			if path_temp != cache_dir:
+				remove(path_temp)
+
+def reader_key(image_path):
+	#A slide replaced on disk gets a new key (as memo_cache_dir)
+	image_path2 = os.path.abspath(image_path)
+	stat1 = os.stat(image_path2)
+
+	return (image_path2, stat1.st_size, stat1.st_mtime_ns)
+
+def get_reader(image_path):
+	
+	key = reader_key(image_path)
+	if key not in _reader_cache:
+		#Close the reader of an older version of the same file
+		for key_old in [item for item in _reader_cache if item[0] == key[0]]:
+			reader_old, _ = _reader_cache.pop(key_old)
+			reader_old.close()
+
+		#Generate Reader
+		omeMeta = metadatatools.createOMEXMLMetadata() #for output
+		ImageReader = F.make_image_reader_class()
+		reader = ImageReader()
+		
+		if _memo_dir is not None:
+			cache_dir = memo_cache_dir(_memo_dir, image_path)
+			os.makedirs(cache_dir, exist_ok=True)
+			
+			Memoizer = make_memoizer_class()
+			reader = Memoizer(reader, cache_dir)
+
+		reader.setMetadataStore(omeMeta)
+		reader.setId(image_path) #parsing VSI/ETS (once per worker, or loading the memo)
+
+		_reader_cache[key] = (reader, omeMeta)
+
+	return _reader_cache[key]
+
+def native_tile_size(reader):
+	#Optimal (native) tile size of the current series, e.g. the ETS tiles of a VSI
+
+	width = javabridge.call(reader.o, "getOptimalTileWidth", "()I")
+	height = javabridge.call(reader.o, "getOptimalTileHeight", "()I")
+
+	return width, height
+
+def close_readers():
+
+	for reader, _ in _reader_cache.values():
+		reader.close()
+	_reader_cache.clear()
+
+def apply_star(func_args):
+	
+	func, args = func_args
+
+	return func(*args)
+
+@contextlib.contextmanager
+def vips_concurrency(n_threads):
+	#libvips threads of one pool job (process-wide setting, restored afterwards)
+	n_threads_prev = pyvips.concurrency_get()
+	pyvips.concurrency_set(n_threads)
+	try:
+		yield
+	finally:
+		pyvips.concurrency_set(n_threads_prev)
+
+def montage_threads(n_cores, n_jobs, pyramid_workers=None, prefetch=True):
+	#libvips and pyramid writer threads per montage job: one budget per job, so that
+	#concurrent jobs x (libvips + writer threads) ~ n_cores (at least one of each)
+	budget = max(1, n_cores // max(1, min(n_jobs, n_cores)))
+
+	if pyramid_workers is None: #libvips tiffsave
+		return budget, None
+
+	if not prefetch: #strips read in the writer thread (e.g. Bio-Formats)
+		return budget, max(1, min(pyramid_workers, budget))
+
+	#libvips computes the next strip while the writer compresses tiles
+	writer_threads = max(1, min(pyramid_workers, budget // 2))
+
+	return max(1, budget - writer_threads), writer_threads
+
+class WorkerPool:
+	#One pool of JVM-backed workers for the whole run or GUI session.
+	#Metadata, export, ray tracing and montage work are submitted to it, so the 
+	#JVM start and Bio-Formats class loading are paid once per worker.
+
+	def __init__(self, n_cores, assigned_RAM, memo_dir=None):
+		
+		self.n_cores = n_cores
+		self.assigned_RAM = assigned_RAM
+		self.memo_dir = memo_dir
+		self.pool = multiprocessing.Pool(processes=n_cores, 
+								   initializer=init_worker, initargs=(assigned_RAM, memo_dir))
+
+	def starmap(self, func, args, chunksize=None):
+		return self.pool.starmap(func, args, chunksize)
+
+	def apply(self, func, args=()):
+		return self.pool.apply(func, args)
+
+	def istarmap(self, func, args):
+		#Yields results as tasks finish (progress is recorded before the phase ends)
+		return self.pool.imap_unordered(apply_star, ((func, item) for item in args))
+
+	def close(self):
+		#Clean shutdown: finish queued work, then let workers release their JVM
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, exc_traceback):
+		self.close()
 	
 #endregion
 
@@ -146,17 +318,12 @@ def metadata_reader_section(image_path):
 	basename1 = os.path.basename(image_path).replace(".vsi", "")
 	folder1 = os.path.join(dirname1, "processed_" + basename1)	
 
-	#Read part of metadata
-	xml1 = bioformats.get_omexml_metadata(image_path, url=None)      
-	xml2 = bioformats.OMEXML(xml1)
+	#Reader (cached in this worker)
+	reader, omeMeta = get_reader(image_path)
 
-	#Generate Reader
-	
-	omeMeta = metadatatools.createOMEXMLMetadata() #for output
-	ImageReader = F.make_image_reader_class()
-	reader = ImageReader()
-	reader.setMetadataStore(omeMeta)
-	reader.setId(image_path)            
+	#Read part of metadata (from the same parse)
+	xml1 = javabridge.call(omeMeta, "dumpXML", "()Ljava/lang/String;")
+	xml2 = bioformats.OMEXML(xml1)
 
 	#Learning about levels
 	series_count = reader.getSeriesCount()
@@ -173,6 +340,7 @@ def metadata_reader_section(image_path):
 		sizeZ = reader.getSizeZ()		  
 		sizeT = reader.getSizeT()  
 		type = reader.getPixelType() #bit depth
+		imageCount = reader.getImageCount() #planes in this series (z-stack)
 
 		#Z-stacks convention (only first layer explains image pyramid)
 		levelZero = xml2.image(series)
@@ -210,51 +378,43 @@ def metadata_reader_section(image_path):
 
 		values.append([series, 
 				 image_ID, layer_name, dimension_order, acquisition_date, pixel_calibration_sel, 
-				 sizeX, sizeY, sizeC, sizeZ, sizeT, type, acquisition_out])	
+				 sizeX, sizeY, sizeC, sizeZ, sizeT, type, imageCount, acquisition_out])	
 
 	df_sizes = pd.DataFrame(values, columns =['series', 
 										   'ID', 'Name', 'dimension_order', 'acquisition_date', 'pixel_calibration_sel',
-										   'sizeX', 'sizeY', 'sizeC', 'sizeZ', 'sizeT', 'type',
+										   'sizeX', 'sizeY', 'sizeC', 'sizeZ', 'sizeT', 'type', 'imageCount',
 										   'Acquisition'
 										   ])
 
 	#Saving in readable format
 	file1 = os.path.join(folder1, 'pyramid_sizes.csv')
 	df_sizes.to_csv(file1, sep=',', index=False)
-
-	reader.close()	
-	atexit.register(javabridge.kill_vm)
 	
 
-def read_metadata_function(image_path, assigned_RAM):	
+def read_metadata_function(image_path, pool):	
+
+	if pool.memo_dir is not None:
+		prune_memo_cache(pool.memo_dir, image_path)
 
 	#Save VSI metadata as CSV
-	args = [(image_path,)] #list of tuples (note: strings are unpacked)		
-	
-	pool = multiprocessing.Pool(processes=1, 
-							 initializer=init_worker, initargs=(assigned_RAM,))	
-	pool.starmap(metadata_reader_section, args)	
+	pool.apply(metadata_reader_section, (image_path,))	
 
 #endregion	
 
 
 #region Save tiles
 
-def save_tiles_function(image_path, sel_level, tileSize, n_cores, assigned_RAM, conditions):	
+def save_process_metadata(image_path, sel_level, tileSize, conditions, export_format="tiles"):	
 
 	#Default
-	sizeC = 3 #for optical microscopy
 	tileSizeX = tileSize #512 
 	tileSizeY = tileSizeX
-	# n_cores = 8	#benchmarked
 
 	#Output folders
 	dirname1 = os.path.dirname(image_path)
 	basename1 = os.path.basename(image_path).replace(".vsi", "")
 	folder1 = os.path.join(dirname1, "processed_" + basename1)	
-	folder2 = os.path.join(folder1, "bf_tiles")
 	mkdir2(folder1)
-	mkdir2(folder2)
 
 	#Read metadata (user readable)	
 	file1 = os.path.join(folder1, 'pyramid_sizes.csv')
@@ -314,33 +474,127 @@ def save_tiles_function(image_path, sel_level, tileSize, n_cores, assigned_RAM,
 		"pixel_size_sel": pixel_size_sel,
 		"layer_names": layer_names2,
 		"series_span": series_span2,		
+		"export_format": export_format, #'tiles' (bf_tiles), 'cube' (bf_cube) or 'direct' (originals transcoded, no export)
 		}
 	
 	with open(file2, 'w') as f:
 		json.dump(data, f, indent=4) # indent for pretty printing	
+
+	return data
+
+def save_tiles_function(image_path, sel_level, tileSize, pool, conditions, export_format="tiles", align_native=True):	
+	#export_format: 'tiles' (one TIFF per tile) or 'cube' (one memory-mapped scratch file per series)
+	#align_native: Bio-Formats reads aligned to the native tile grid (see reader_section)
+
+	#Default
+	sizeC = 3 #for optical microscopy
+	# n_cores = 8	#benchmarked
+
+	#Output folders
+	dirname1 = os.path.dirname(image_path)
+	basename1 = os.path.basename(image_path).replace(".vsi", "")
+	folder1 = os.path.join(dirname1, "processed_" + basename1)	
+	folder2 = os.path.join(folder1, "bf_tiles" if export_format == "tiles" else "bf_cube")
+
+	data = save_process_metadata(image_path, sel_level, tileSize, conditions, export_format)
+	mkdir2(folder2)
+
+	tileSizeX = data["tileSizeX"]
+	tileSizeY = data["tileSizeY"]
+	series_span2 = data["series_span"]
+
+	df_sizes = pd.read_csv(os.path.join(folder1, 'pyramid_sizes.csv'), sep=',')
+
+	#Resumable runs (tile rows already exported with the same inputs are skipped)
+	manifest = RunManifest(folder1)
+	manifest.drop_missing("export/", 6) #tile or cube path
+	export_fp = export_fingerprint(data)
+	
+	#Work units: blocks of tile rows across series and z planes (keeps every core busy)
+	units = []
+	keys_all = []
+	cubes = {} #scratch cube layouts (per series)
+	for series in series_span2:
+		idx = df_sizes['series'] == series
+		sizeX = int(df_sizes.loc[idx, 'sizeX'].array[0])
+		sizeY = int(df_sizes.loc[idx, 'sizeY'].array[0])
+		image_count = int(df_sizes.loc[idx, 'imageCount'].array[0]) #Data tree = 1; z-stack = # of planes
+
+		nYTiles = int(math.ceil(sizeY / tileSizeY))
+
+		if export_format == "cube":
+			cubes[str(series)] = cube_layout(folder2, series, sizeY, sizeX, sizeC, image_count)
+			create_cube(cubes[str(series)])
+
+		for image in range(image_count):
+			#output folder (created before dispatch)
+			if export_format == "tiles":
+				basename2 = f"series{series}_z{image}"
+				output_1 = os.path.join(folder2, basename2)	    
+				mkdir2(output_1)
+
+			keys_temp = [export_key(series, image, y) for y in range(nYTiles)]
+			keys_all.extend(keys_temp)
+
+			y_missing = [y for y, key in zip(range(nYTiles), keys_temp) if not manifest.is_done(key, export_fp)]
+			if y_missing:
+				units.append((series, image, y_missing))
+
+	#Shape and offsets of the scratch cubes (read by later phases)
+	if export_format == "cube":
+		data["cubes"] = cubes
+		with open(os.path.join(folder1, 'experimental_metadata.json'), 'w') as f:
+			json.dump(data, f, indent=4)
+
+	n_rows = sum([len(item[2]) for item in units])
+	n_units = 4*pool.n_cores #small work units balance slow series
+	rows_per_unit = max(1, int(math.ceil(n_rows / n_units)))
+	print(f"Exporting {n_rows} of {len(keys_all)} tile rows")
 	
 	#Save VSI montage as TIF tiles
-	args = ((image_path, series, tileSizeX, sizeC, folder2)
-		 for series in series_span2)		
+	args = ((image_path, series, image, y_missing[i:i + rows_per_unit], tileSizeX, sizeC, folder2, cubes.get(str(series)), align_native)
+		 for series, image, y_missing in units
+		 for i in range(0, len(y_missing), rows_per_unit))		
 	
-	pool = multiprocessing.Pool(processes=n_cores, 
-							 initializer=init_worker, initargs=(assigned_RAM,))	
-	pool.starmap(reader_section, args)
+	#Recording progress as units finish
+	t0 = time.perf_counter()
+	n_bytes = 0
+	for values_unit in pool.istarmap(reader_section, args):
+		n_bytes += sum([row[4]*row[5]*sizeC for row in values_unit])
+		
+		rows_grouped = {}
+		for row in values_unit:
+			key = export_key(row[0], row[1], row[3]) #series, z, y
+			rows_grouped.setdefault(key, []).append(row)
+		
+		for key, rows in rows_grouped.items():
+			manifest.mark_done(key, export_fp, rows)
+		manifest.flush() #per work unit
 
+	manifest.close()
+
+	#Export throughput
+	if n_rows > 0:
+		t_export = time.perf_counter() - t0
+		print(f"Exported {n_bytes/2**20:.0f} MB in {t_export:.1f} s ({n_bytes/2**20/t_export:.1f} MB/s, {'native-aligned' if align_native else 'unaligned'} reads)")
+
+	#Tile manifest (later phases do not scan or open the tiles)
+	values2 = manifest.rows(keys_all)
+
+	save_tiling(values2, folder1)
+
+def export_key(series, image, y):
+
+	return f"export/series{series}_z{image}_y{y}"
 
-def reader_section(image_path, series, tileSizeX, sizeC, folder2):		
-	 
-	#Generate Reader		
-	
-	omeMeta = metadatatools.createOMEXMLMetadata() #for output	
-	
-	ImageReader = F.make_image_reader_class()
-	reader = ImageReader()
-	reader.setMetadataStore(omeMeta)
-	reader.setId(image_path)
 
-	image_count = reader.getImageCount() #Data tree = 1; z-stack = # of planes		  	
-	image_span = range(image_count)
+def reader_section(image_path, series, image, y_list, tileSizeX, sizeC, folder2, cube=None, align_native=False):		
+	#Exports tile rows (y_list) of one series and z plane (as TIFF tiles or into its scratch cube)
+	#align_native: read blocks aligned to the native (e.g. ETS) tile grid and cut them into output tiles,
+	#so each native tile is decoded once (unaligned tileSize grids decode some native tiles 2-4 times)
+	 
+	#Reader (cached in this worker)
+	reader, _ = get_reader(image_path)
 
 	reader.setSeries(series)
 	sizeX = reader.getSizeX()
@@ -349,23 +603,84 @@ def reader_section(image_path, series, tileSizeX, sizeC, folder2):
 	#Default
 	tileSizeY = tileSizeX	
 
-	for image in image_span: #XPL		
-		
-		#output folder
-		basename2 = f"series{series}_z{image}"
-		output_1 = os.path.join(folder2, basename2)	    
-		mkdir2(output_1)
-	
-		#Calculate tiles
-		nXTiles = int(math.floor(sizeX / tileSizeX))
-		nYTiles = int(math.floor(sizeY / tileSizeY))
-		if nXTiles * tileSizeX != sizeX:
-			nXTiles = nXTiles + 1
-		if nYTiles * tileSizeY != sizeY:
-			nYTiles = nYTiles + 1
+	#output folder
+	basename2 = f"series{series}_z{image}"
+	output_1 = os.path.join(folder2, basename2)	    
+
+	if cube is not None:
+		plane = open_plane(cube, image, mode='r+') #other workers write other rows
+
+	#Calculate tiles
+	nXTiles = int(math.floor(sizeX / tileSizeX))
+	if nXTiles * tileSizeX != sizeX:
+		nXTiles = nXTiles + 1
 
+	def write_tile(buf, x, y):
+		tileX = x * tileSizeX
+		tileY = y * tileSizeY
+		effTileSizeY, effTileSizeX = buf.shape[:2]
+
+		#Write tiles
+		if cube is not None:
+			plane[tileY:tileY + effTileSizeY, tileX:tileX + effTileSizeX] = buf
+			file_temp = cube["path"]
+		else:
+			name_str = f'tile_x{x:03.0f}_y{y:03.0f}.tif' #following Stitching plugin
+			file_temp = os.path.join(output_1, name_str)
+			image_output = pyvips.Image.new_from_array(buf)                            
+			image_output.write_to_file(file_temp) 
+
+		return [series, image, x, y, effTileSizeX, effTileSizeY, file_temp]
+
+	values_unit = [] #manifest rows
+	if align_native:
+		nativeX, nativeY = native_tile_size(reader)
+
+		#Consecutive tile rows share one band (native rows spanning two tile rows are read once)
+		runs = []
+		for y in y_list:
+			if runs and (runs[-1][-1] == y - 1) and (len(runs[-1]) < 8): #bounded band memory
+				runs[-1].append(y)
+			else:
+				runs.append([y])
+
+		for run in runs:
+			#Band rows, aligned to the native grid
+			bandY0 = (run[0] * tileSizeY) // nativeY * nativeY
+			bandY1 = min(sizeY, -(-min(sizeY, (run[-1] + 1) * tileSizeY) // nativeY) * nativeY)
+
+			#Native-aligned column blocks, kept until their last output tile is cut
+			band = None
+			bandX0 = bandX1 = 0
+			for x in range(nXTiles):
+				tileX = x * tileSizeX
+				tileX1 = min(sizeX, tileX + tileSizeX)
+
+				if tileX1 > bandX1:
+					blockX0 = max(bandX1, tileX // nativeX * nativeX)
+					blockX1 = min(sizeX, -(-tileX1 // nativeX) * nativeX)
+
+					buf = reader.openBytesXYWH(image, blockX0, bandY0, blockX1 - blockX0, bandY1 - bandY0)
+					buf.shape = (bandY1 - bandY0, blockX1 - blockX0, sizeC) #interleaved (see VSI metadata)
+
+					if (band is not None) and (bandX1 > tileX) and (blockX0 == bandX1):
+						band = np.concatenate([band[:, tileX - bandX0:], buf], axis= 1)
+						bandX0 = tileX
+					else:
+						band = buf
+						bandX0 = blockX0
+					bandX1 = blockX1
+
+				for y in run:
+					tileY = y * tileSizeY
+					tileY1 = min(sizeY, tileY + tileSizeY)
+					
+					buf = band[tileY - bandY0:tileY1 - bandY0, tileX - bandX0:tileX1 - bandX0]
+					values_unit.append(write_tile(np.ascontiguousarray(buf), x, y))
+
+	else:
 		#Extract, row-wise (pythonic order)
-		for y in range(nYTiles):
+		for y in y_list:
 			for x in range(nXTiles):
 				# The x and y coordinates for the current tile
 				tileX = x * tileSizeX
@@ -382,50 +697,92 @@ def reader_section(image_path, series, tileSizeX, sizeC, folder2):
 				buf = reader.openBytesXYWH(image, tileX, tileY, effTileSizeX, effTileSizeY)
 				buf.shape = (effTileSizeY, effTileSizeX, sizeC) #interleaved (see VSI metadata)					
 
-				#Write tiles
-				name_str = f'tile_x{x:03.0f}_y{y:03.0f}.tif' #following Stitching plugin
-				file_temp = os.path.join(output_1, name_str)
-				image_output = pyvips.Image.new_from_array(buf)                            
-				image_output.write_to_file(file_temp) 
-	reader.close()
+				values_unit.append(write_tile(buf, x, y))
+
+	if cube is not None:
+		plane.flush() #on disk before the rows are recorded as done
+		del plane
+
+	return values_unit
+
+def load_tile(source):
+	#Exported tile: TIFF path or (layout, z, left, top, width, height) of a scratch cube (zero-copy view)
+	
+	if isinstance(source, str):
+		return pyvips.Image.new_from_file(source).numpy()
+	
+	return read_region(*source)
+
+VIPS_FORMATS = {"uint8": "uchar", "uint16": "ushort", "float32": "float"}
+
+def load_raw(layout, z, tiles_accross, cell_size):
+	#Lazy plane of a raw container, padded as arrayjoin (same montage size as the tile files)
+	sizeY, sizeX, sizeC = layout["shape"]
+	
+	image_stitched = pyvips.Image.rawload(layout["path"], sizeX, sizeY, sizeC, offset= layout["offsets"][z], 
+									   format= VIPS_FORMATS[layout["dtype"]])
 	
-	atexit.register(javabridge.kill_vm)
+	tiles_down = int(math.ceil(sizeY / cell_size[1]))
+
+	return image_stitched.embed(0, 0, tiles_accross*cell_size[0], tiles_down*cell_size[1])
+
+def load_montage(data, grid_paths, series, z, tiles_accross, cell_size):
+	#Lazy montage of one series and z plane (arrayjoin of its tiles or a raw view of its scratch cube)
+
+	if data.get("export_format", "tiles") == "cube":
+		image_stitched = load_raw(data["cubes"][str(series)], z, tiles_accross, cell_size)
+
+	else:
+		image_paths = grid_paths.ravel() #row-wise
+		image_tiles = [pyvips.Image.new_from_file(path_temp) for path_temp in image_paths]
+		
+		image_stitched = pyvips.Image.arrayjoin(image_tiles, across= tiles_accross)
+
+	return image_stitched
 	
 #endregion
 
 #region Ray Tracing
 
-def ray_tracing_function(workingDir1, modality_list, statistic_list, n_cores):	
+def ray_tracing_function(workingDir1, modality_list, statistic_list, pool, rt_encoding="compact", rt_compression=None, rt_format="tiles"):	
+	#rt_encoding: statistic tiles as 'float32' or 'compact' (see encode_statistic); rt_compression: None, 'lzw' or 'deflate'
+	#rt_format: 'tiles'= one TIFF per statistic tile, 'cube'= tiles written into one raw container per (modality, statistic, z)
+
 	# n_cores = 8 #performance of 8-12 flattens
 
 	#Recovering metadata	
 	path1 = os.path.join(workingDir1, 'experimental_metadata.json')	
 
-	#Default	
-	n_channels = 3 #for optical microscopy
-	
 	#JSON
 	with open(path1, 'r') as f:
 		data = json.load(f)
 
-	
 	series_span = data["series_span"] 
 	layer_names = data["layer_names"] #follows series_span	
-
-	#Learning tile arrangement
-	fileList = glob.glob(f"{workingDir1}/**/**/*.tif", recursive = False) #only in current dir 	
-	pattern = re.compile(r".+\\series(\d+)_z(\d+)\\tile_x(\d+)_y(\d+)\.tif")			
-	
-	df1 = understand_tiling(fileList, pattern, workingDir1)
-
-	#Processing metadata	
-	z_list = df1['z'].unique() #assuming it applies to all the file		
+	tileSizeX = data["tileSizeX"]
+	tileSizeY = data["tileSizeY"]
+	cubes = data.get("cubes") #scratch cube export
+
+	#Learning tile arrangement (manifest written at export)
+	df1 = load_tiling(workingDir1)
+
+	#Resumable runs
+	manifest = RunManifest(workingDir1)
+	manifest.drop_missing("rt/", 5) #statistic tile or container path
+	export_fp = export_fingerprint(data)
+	keys_all = []
+	histograms = load_histograms(workingDir1) #merged per montage (contrast thresholds)
+	rt_cubes = {}
+
+	#Indexed tile table (series, z, y, x)
+	grid_paths, positions = tile_grid(df1, ['series', 'z', 'y', 'x'])
+	grid_width, _ = tile_grid(df1, ['series', 'z', 'y', 'x'], 'width')
+	grid_height, _ = tile_grid(df1, ['series', 'z', 'y', 'x'], 'height')
+	series_pos, z_pos, y_pos, x_pos = positions
 	
 	#logical list within a list
 	series_lists = [ [layer.find(modality_str) != -1 for layer in layer_names] for modality_str in modality_list ]
 	
-	values2 = [] #table
-
 	for items, modality_str in zip(series_lists, modality_list):
 		print(modality_str)
 
@@ -434,83 +791,454 @@ def ray_tracing_function(workingDir1, modality_list, statistic_list, n_cores):
 		mkdir2(output_folder)
 
 		series_span2 = list(compress(series_span, items)) #subset list with logical list	 			 
-		n_layers = len(series_span2)
+		series_idx = [series_pos[series] for series in series_span2]
 		
-		#Getting x-y information		        
-		series_1 = series_span2[0] #assuming selection covers only one level
-		idx1 = df1['series'] == series_1        
-		df_a = df1.loc[idx1, :] #df
-		y_list = df_a['y'].unique()
-		x_list = df_a['x'].unique()
+		#Tile sizes from the first layer		        
+		series_1 = series_idx[0] #assuming selection covers only one level
+		
+		#Statistics still missing (or stale) per tile
+		rt_fps = {sel_stats: rt_fingerprint(export_fp, modality_str, sel_stats, rt_encoding, rt_format) for sel_stats in statistic_list}
+		
+		#Containers (montage size from the first layer)
+		if rt_format == "cube":
+			sizeX = int(grid_width[series_1, 0, 0, :].sum())
+			sizeY = int(grid_height[series_1, 0, :, 0].sum())
+			rt_cubes.update(rt_containers(output_folder, modality_str, statistic_list, list(z_pos), sizeY, sizeX, 3, len(series_span2), rt_encoding))
 		
 		#Loop (assuming no missing tiles)	
-		for sel_stats in statistic_list:
-			for z in z_list:	
+		for z in z_pos: #assuming it applies to all the file	
+
+			tiles_missing = []
+			for y in y_pos:
+				for x in x_pos:
+					keys_temp = [rt_key(modality_str, z, x, y, sel_stats) for sel_stats in statistic_list]
+					keys_all.extend(keys_temp)
+
+					stats_missing = [sel_stats for sel_stats, key in zip(statistic_list, keys_temp) if not manifest.is_done(key, rt_fps[sel_stats])]
+					if stats_missing:
+						tiles_missing.append((x, y, stats_missing))
+
+			#Slim payloads: each task carries only its own inputs (not the tile table)
+			args = []
+			for x, y, stats_missing in tiles_missing:
+				tile_width = int(grid_width[series_1, z_pos[z], y_pos[y], x_pos[x]])
+				tile_height = int(grid_height[series_1, z_pos[z], y_pos[y], x_pos[x]])
+
+				if cubes is None:
+					sources = grid_paths[series_idx, z_pos[z], y_pos[y], x_pos[x]].tolist()
+				else:
+					sources = [(cubes[str(series)], z, x*tileSizeX, y*tileSizeY, tile_width, tile_height) for series in series_span2]
 
-				idx1 = df1['z'] == z
-				df2 = df1.loc[idx1, :] #shortened
+				targets = None
+				if rt_format == "cube":
+					targets = {sel_stats: (rt_cubes[f"{modality_str}_{sel_stats}_z{z}"], x*tileSizeX, y*tileSizeY) for sel_stats in stats_missing}
 
-				#Process tiles in parallel
-				args = ((df2, x, y, z, series_span2, sel_stats, modality_str, n_channels, n_layers, output_folder)
-					for y in y_list
-					for x in x_list)					
-				
-				pool = multiprocessing.Pool(processes=n_cores)	
-				values1 = pool.starmap(process_tile_rt, args)				
-				
-				values2.extend(values1)					
+				args.append((sources, x, y, z, tile_width, tile_height, stats_missing, modality_str, output_folder, rt_encoding, rt_compression, targets))
+
+			if args: #payload sent to the workers
+				task_bytes = [len(pickle.dumps(item)) for item in args]
+				print(f"{modality_str} z{z}: {len(args)} tasks, pickled bytes per task mean={np.mean(task_bytes):.0f} max={np.max(task_bytes)}")
+			
+			#Process tiles in parallel (one read of the angle stack for all statistics)
+			montage_hists = {}
+			for values_tile, histograms_tile in pool.istarmap(process_tile_rt, args):
+				for row in values_tile:
+					key = rt_key(modality_str, row[0], row[1], row[2], row[6]) #z, x, y, statistic
+					manifest.mark_done(key, rt_fps[row[6]], [row])
+				manifest.flush() #per tile
+				update_montage_histograms(montage_hists, z, histograms_tile)
+
+			stats_counts = {(sel_stats, z): sum([sel_stats in item[2] for item in tiles_missing]) for sel_stats in statistic_list}
+			store_montage_histograms(histograms, montage_hists, stats_counts, len(y_pos)*len(x_pos), modality_str, rt_fps)
+			save_histograms(histograms, workingDir1)
 			
+	manifest.close()
+
+	if rt_format == "cube":
+		save_rt_containers(workingDir1, rt_cubes)
+
 	#Write setup	
+	values2 = manifest.rows(keys_all)
+
 	items_str2 = ['z', 'x', 'y', 'width', 'height', 'image_path', 'statistic', 'modality']	
 	df_rt = pd.DataFrame(values2, columns = items_str2)		
 	df_rt.to_csv(os.path.join(workingDir1, 'files2.csv'), index=False)      
 
-def process_tile_rt(df2, x, y, z, series_span2, sel_stats, modality_str, n_channels, n_layers, output_folder):							
+def rt_key(modality_str, z, x, y, sel_stats):
 
-	idx2 = df2['x'] == x
-	idx3 = df2['y'] == y
-	idx = idx2 & idx3
+	return f"rt/{modality_str}_z{z}_x{x}_y{y}_{sel_stats}"
 
-	df3 = df2.loc[idx, :] #shortened					 
+def rt_fingerprint(export_fp, modality_str, sel_stats, rt_encoding="float32", rt_format="tiles"):
 	
-	tile_width = df3['width'].array[0] #when dissimilar tiles
-	tile_height = df3['height'].array[0]
-	shape = (tile_height, tile_width, n_channels, n_layers) 
+	if rt_format != "tiles":
+		return fingerprint(export_fp, modality_str, sel_stats, rt_encoding, rt_format)
+
+	if rt_encoding == "float32": #earlier runs stay valid
+		return fingerprint(export_fp, modality_str, sel_stats)
+
+	return fingerprint(export_fp, modality_str, sel_stats, rt_encoding)
+
+def rt_containers(output_folder, modality_str, statistic_list, z_list, sizeY, sizeX, sizeC, n_layers, rt_encoding):
+	#One preallocated raw container per (statistic, z) of a modality (rt_format= 'cube')
+	formats = statistic_formats(statistic_list, n_layers, sizeC, rt_encoding)
+
+	rt_cubes = {}
+	for sel_stats, (dtype, n_channels) in formats.items():
+		for z in z_list:
+			name = f"{modality_str}_{sel_stats}_z{z}"
+			rt_cubes[name] = raw_layout(os.path.join(output_folder, f"{name}.raw"), sizeY, sizeX, n_channels, 1, dtype)
+			create_cube(rt_cubes[name])
+
+	return rt_cubes
 
-	tile_temp = np.zeros(shape, dtype= np.float32) #pre-allocate						
+def save_rt_containers(workingDir1, rt_cubes):
+	#Shape and dtype of the ray tracing containers (read by the join)
+	file1 = os.path.join(workingDir1, 'experimental_metadata.json')
+
+	with open(file1, 'r') as f:
+		data = json.load(f)
 	
-	for series, i in zip(series_span2, range(n_layers)):
-		# print(f"{x}, {y}, {z}, {series}")						
+	data["rt_cubes"] = rt_cubes
+	with open(file1, 'w') as f:
+		json.dump(data, f, indent=4)
+
+def write_statistic_tile(tile_temp2, sel_stats, target, rt_encoding, rt_compression):
+	#target: TIFF path or (layout, left, top) region of a ray tracing container (rt_format= 'cube')
+
+	tile_encoded = encode_statistic(tile_temp2, sel_stats, rt_encoding)
+
+	if not isinstance(target, str):
+		layout, left, top = target
+		plane = open_plane(layout, 0, 'r+')
+		plane[top:top + tile_encoded.shape[0], left:left + tile_encoded.shape[1]] = tile_encoded
+		plane.flush()
+
+		return tile_encoded
+
+	image_output = pyvips.Image.new_from_array(tile_encoded)                           
+	
+	if rt_compression is None:
+		image_output.write_to_file(target)  
+	else:
+		image_output.write_to_file(target, compression= rt_compression, predictor= "horizontal") #lossless
+
+	return tile_encoded
+
+def statistic_histograms(tile_encoded, sel_stats):
+	#Only the contrast-stretched statistic (std) stored as integers (see join_rt_tiles_function)
+
+	condition = sel_stats == "std"
+	if condition and np.issubdtype(tile_encoded.dtype, np.integer):
+		return [(sel_stats, tile_histograms(tile_encoded))]
+
+	return []
 
-		idx4 = df3['series'] == series							
-		path_temp = df3.loc[idx4, 'image_path'].array[0]
+def update_montage_histograms(montage_hists, z, histograms_tile):
+	for sel_stats, histograms_channels in histograms_tile:
+		montage_hists[(sel_stats, z)] = merge_histograms(montage_hists.get((sel_stats, z)), histograms_channels)
+
+def store_montage_histograms(histograms, montage_hists, stats_counts, n_tiles, modality_str, rt_fps):
+	#Montages recomputed in full keep their merged histogram; partly resumed ones drop it (join fallback)
+
+	for (sel_stats, z), count in stats_counts.items():
+		name = f"{modality_str}_{sel_stats}_z{z}"
+
+		if (count == n_tiles) and ((sel_stats, z) in montage_hists):
+			histograms[name] = (montage_hists[(sel_stats, z)], rt_fps[sel_stats])
+		elif count > 0:
+			histograms.pop(name, None)
+
+def process_tile_rt(sources, x, y, z, tile_width, tile_height, statistic_list, modality_str, output_folder, rt_encoding="compact", rt_compression=None, targets=None):							
+	#sources: angle tiles in acquisition order (series_span), see load_tile
+	#targets: {statistic: (layout, left, top)} container regions (None= one TIFF per tile)
+
+	n_layers = len(sources)
+	accumulator = StatisticAccumulator(statistic_list, n_layers) #folds one angle at a time
+	
+	for source in sources:
 
 		#Load image
-		im_temp = pyvips.Image.new_from_file(path_temp)    							
-		tile_temp[:, :, :, i] = im_temp.numpy()							
+		accumulator.update(load_tile(source))
 
-	tile_temp2 = calculate_statistic(tile_temp, sel_stats)						
+	statistics = accumulator.result()						
 	
+	values_tile = []
+	histograms_tile = [] #sparse, per channel
+	for sel_stats, tile_temp2 in statistics.items():
 	
-	#Write tiles
-	name_str = f'tile_x{x:03.0f}_y{y:03.0f}_z{z:03.0f}_{sel_stats}.tif' #Stitching plugin
-	file_temp = os.path.join(output_folder, name_str)
+		#Write tiles
+		if targets is None:
+			name_str = f'tile_x{x:03.0f}_y{y:03.0f}_z{z:03.0f}_{sel_stats}.tif' #Stitching plugin
+			target = os.path.join(output_folder, name_str)
+			file_temp = target
+		else:
+			target = targets[sel_stats]
+			file_temp = target[0]["path"]
+		
+		tile_encoded = write_statistic_tile(tile_temp2, sel_stats, target, rt_encoding, rt_compression)
+		histograms_tile.extend(statistic_histograms(tile_encoded, sel_stats))
+
+		values_tile.append([z, x, y, tile_width, tile_height, file_temp, sel_stats, modality_str])
+			
+	return values_tile, histograms_tile
+
+
+def ray_tracing_direct_function(image_path, sel_level, tileSize, modality_list, statistic_list, pool, rt_encoding="compact", rt_compression=None, rt_format="tiles"):	
+	#Tile-major mode for ray-tracing-only runs: each task reads tile (x, y) of every 
+	#PPL/XPL series with Bio-Formats and reduces it in memory (no 'bf_tiles' round trip)
+
+	#Default	
+	sizeC = 3 #for optical microscopy
+
+	#Folder convention
+	dirname1 = os.path.dirname(image_path)
+	basename1 = os.path.basename(image_path).replace(".vsi", "")
+	workingDir1 = os.path.join(dirname1, "processed_" + basename1)
+
+	#Only the modalities being ray traced are selected
+	conditions = [False, "ppl" in modality_list, "xpl" in modality_list, False, True]
+	data = save_process_metadata(image_path, sel_level, tileSize, conditions)
 	
-	image_output = pyvips.Image.new_from_array(tile_temp2) #requires float32                            
-	image_output.write_to_file(file_temp)  
+	tileSizeX = data["tileSizeX"]
+	tileSizeY = data["tileSizeY"]
+	series_span = data["series_span"]
+	layer_names = data["layer_names"]
+
+	df_sizes = pd.read_csv(os.path.join(workingDir1, 'pyramid_sizes.csv'), sep=',')
+
+	#Resumable runs (the source file, level and tile size define the inputs)
+	manifest = RunManifest(workingDir1)
+	manifest.drop_missing("rt/", 5) #statistic tile or container path
+	export_fp = export_fingerprint(data)
+	keys_all = []
+	histograms = load_histograms(workingDir1) #merged per montage (contrast thresholds)
+	rt_cubes = {}
+
+	#logical list within a list
+	series_lists = [ [layer.find(modality_str) != -1 for layer in layer_names] for modality_str in modality_list ]
+
+	for items, modality_str in zip(series_lists, modality_list):
+		print(modality_str)
+
+		#Output folder
+		output_folder = os.path.join(workingDir1, f"rt_{modality_str}")
+		mkdir2(output_folder)
+
+		series_span2 = list(compress(series_span, items)) #subset list with logical list	 			 
+		rt_fps = {sel_stats: rt_fingerprint(export_fp, modality_str, sel_stats, rt_encoding, rt_format) for sel_stats in statistic_list}
+		
+		#Getting x-y information (assuming selection covers only one level)
+		series_1 = series_span2[0]
+		idx1 = df_sizes['series'] == series_1
+		sizeX = int(df_sizes.loc[idx1, 'sizeX'].array[0])
+		sizeY = int(df_sizes.loc[idx1, 'sizeY'].array[0])
+		image_count = int(df_sizes.loc[idx1, 'imageCount'].array[0])
+
+		nXTiles = int(math.ceil(sizeX / tileSizeX))
+		nYTiles = int(math.ceil(sizeY / tileSizeY))
+
+		if rt_format == "cube":
+			rt_cubes.update(rt_containers(output_folder, modality_str, statistic_list, range(image_count), sizeY, sizeX, sizeC, len(series_span2), rt_encoding))
+
+		#One task per tile row (with the statistics still missing per tile)
+		args = []
+		stats_counts = {(sel_stats, z): 0 for sel_stats in statistic_list for z in range(image_count)}
+		for z in range(image_count):
+			for y in range(nYTiles):
+				
+				tiles_missing = []
+				for x in range(nXTiles):
+					keys_temp = [rt_key(modality_str, z, x, y, sel_stats) for sel_stats in statistic_list]
+					keys_all.extend(keys_temp)
+
+					stats_missing = [sel_stats for sel_stats, key in zip(statistic_list, keys_temp) if not manifest.is_done(key, rt_fps[sel_stats])]
+					if stats_missing:
+						tiles_missing.append((x, stats_missing))
+					for sel_stats in stats_missing:
+						stats_counts[(sel_stats, z)] += 1
+				
+				if tiles_missing:
+					layouts = None
+					if rt_format == "cube":
+						layouts = {sel_stats: rt_cubes[f"{modality_str}_{sel_stats}_z{z}"] for sel_stats in statistic_list}
+
+					args.append((image_path, y, z, tiles_missing, tileSizeX, tileSizeY, sizeX, sizeY, sizeC, series_span2, modality_str, output_folder, rt_encoding, rt_compression, layouts))
+		
+		montage_hists = {}
+		for values_row, histograms_row in pool.istarmap(process_tile_row_direct, args):
+			for row in values_row:
+				key = rt_key(modality_str, row[0], row[1], row[2], row[6]) #z, x, y, statistic
+				manifest.mark_done(key, rt_fps[row[6]], [row])
+			manifest.flush() #per tile row
+			update_montage_histograms(montage_hists, values_row[0][0], histograms_row)
+
+		store_montage_histograms(histograms, montage_hists, stats_counts, nXTiles*nYTiles, modality_str, rt_fps)
+		save_histograms(histograms, workingDir1)
+
+	manifest.close()
+
+	if rt_format == "cube":
+		save_rt_containers(workingDir1, rt_cubes)
+
+	#Write setup	
+	values2 = manifest.rows(keys_all)
+
+	items_str2 = ['z', 'x', 'y', 'width', 'height', 'image_path', 'statistic', 'modality']	
+	df_rt = pd.DataFrame(values2, columns = items_str2)		
+	df_rt.to_csv(os.path.join(workingDir1, 'files2.csv'), index=False)      
+
+def process_tile_row_direct(image_path, y, z, tiles_missing, tileSizeX, tileSizeY, sizeX, sizeY, sizeC, series_span2, modality_str, output_folder, rt_encoding="compact", rt_compression=None, layouts=None):
+	#tiles_missing: [(x, statistic_list)] of this tile row
+	#layouts: {statistic: layout} containers of this z plane (None= one TIFF per tile)
 
-	values_tile = [z, x, y, tile_width, tile_height, file_temp, sel_stats, modality_str]
+	#Reader (cached in this worker)
+	reader, _ = get_reader(image_path)
+
+	n_layers = len(series_span2)
+
+	tileY = y * tileSizeY
+	effTileSizeY = min(tileSizeY, sizeY - tileY)
+
+	values_row = []
+	histograms_row = [] #sparse, per channel
+	for x, statistic_list in tiles_missing:
+		tileX = x * tileSizeX
+		effTileSizeX = min(tileSizeX, sizeX - tileX)
+
+		accumulator = StatisticAccumulator(statistic_list, n_layers) #folds one angle at a time
+
+		for series in series_span2:
+			reader.setSeries(series)
+
+			buf = reader.openBytesXYWH(z, tileX, tileY, effTileSizeX, effTileSizeY)
+			buf.shape = (effTileSizeY, effTileSizeX, sizeC) #interleaved (see VSI metadata)
+			accumulator.update(buf)
+
+		statistics = accumulator.result()
+
+		for sel_stats, tile_temp2 in statistics.items():
+
+			#Write tiles
+			if layouts is None:
+				name_str = f'tile_x{x:03.0f}_y{y:03.0f}_z{z:03.0f}_{sel_stats}.tif' #Stitching plugin
+				target = os.path.join(output_folder, name_str)
+				file_temp = target
+			else:
+				target = (layouts[sel_stats], tileX, tileY)
+				file_temp = layouts[sel_stats]["path"]
 			
-	return values_tile
+			tile_encoded = write_statistic_tile(tile_temp2, sel_stats, target, rt_encoding, rt_compression)
+			histograms_row.extend(statistic_histograms(tile_encoded, sel_stats))
+
+			values_row.append([z, x, y, effTileSizeX, effTileSizeY, file_temp, sel_stats, modality_str])
+
+	return values_row, histograms_row
+
+def ray_tracing_vips_function(workingDir1, modality_list, statistic_list, percentOut_dsaImage, rt_pack=False, pyramid_workers=None):
+	#Whole-montage mode (rt_engine= 'vips'): every angle montage is opened lazily (exported 
+	#tiles or scratch cube) and the statistics are a libvips graph evaluated while the pyramid is 
+	#written (no angle stacks in Python, no 'rt_' tiles or float32 intermediates)
+
+	#Output folder
+	path0 = os.path.join(workingDir1, 'montages_rt')
+	mkdir2(path0)
+
+	#Recovering metadata	
+	path1 = os.path.join(workingDir1, 'experimental_metadata.json')	
+
+	#JSON
+	with open(path1, 'r') as f:
+		data = json.load(f)
+
+	series_span = data["series_span"] 
+	layer_names = data["layer_names"] #follows series_span	
+
+	#Learning tile arrangement (manifest written at export)
+	df1 = load_tiling(workingDir1)
+
+	#Indexed tile table (series, z, y, x)
+	grid_paths, positions = tile_grid(df1, ['series', 'z', 'y', 'x'])
+	series_pos, z_pos = positions[0], positions[1]
+
+	tiles_accross = grid_paths.shape[-1] #assuming same pyramid level
+	cell_size = (int(df1['width'].max()), int(df1['height'].max()))
+
+	#Resumable runs
+	manifest = RunManifest(workingDir1)
+	export_fp = export_fingerprint(data)
+
+	#logical list within a list
+	series_lists = [ [layer.find(modality_str) != -1 for layer in layer_names] for modality_str in modality_list ]
+	
+	for items, modality_str in zip(series_lists, modality_list):
+		print(modality_str)
+
+		series_span2 = list(compress(series_span, items)) #subset list with logical list	 			 
+
+		for z in z_pos: #assuming it applies to all the file
+			
+			#Inputs of each statistic montage
+			montage_fps = {}
+			for sel_stats in statistic_list:
+				condition = sel_stats == "std" #contrast stretched			
+				montage_fps[sel_stats] = fingerprint(rt_fingerprint(export_fp, modality_str, sel_stats), "vips", percentOut_dsaImage if condition else None)
+
+			#Output files (one per statistic, or one pack) still missing (or stale)
+			if rt_pack:
+				outputs = [(f"{modality_str}_stats_z{z}.tif", list(statistic_list), fingerprint(*[montage_fps[sel_stats] for sel_stats in statistic_list]))]
+			else:
+				outputs = [(f"{modality_str}_{sel_stats}_z{z}.tif", [sel_stats], montage_fps[sel_stats]) for sel_stats in statistic_list]
+
+			outputs = [item for item in outputs 
+				if not (manifest.is_done(f"montage/rt/{item[0]}", item[2]) and os.path.exists(os.path.join(path0, item[0])))]
+
+			if not outputs:
+				continue
+
+			#Lazy angle montages (acquisition order)
+			angle_montages = [load_montage(data, grid_paths[series_pos[series], z_pos[z]], series, z, tiles_accross, cell_size) for series in series_span2]
+
+			statistics = vips_statistics(angle_montages, [sel_stats for item in outputs for sel_stats in item[1]])
+
+			for file_output, statistic_list2, montage_fp in outputs:
+				print(f"{modality_str} montage {', '.join(statistic_list2)}")
+
+				montages = []
+				for sel_stats in statistic_list2:
+					montage, channel_names = rt_montage_uint8(statistics[sel_stats], sel_stats, percentOut_dsaImage, None, len(series_span2))
+					montages.append((sel_stats, montage, channel_names))
+				
+				write_montage_pyramid(montages, os.path.join(path0, file_output), data, pyramid_workers)
+
+				manifest.mark_done(f"montage/rt/{file_output}", montage_fp)
+				manifest.flush()
+
+	manifest.close()
 			
 #endregion
 
 #region Write OME
 
-def ready_for_OME(channel_list, file_output, dimension_order, dimension_sizes, pixel_size_sel):		
+RGB_COLORS = ["-16777216", "16711680", "65280"] #OME channel colours (R, G, B)
+
+def ready_for_OME(channel_list, file_output, dimension_order, dimension_sizes, pixel_size_sel, channel_names=None, channel_colors=None):		
+	#channel_names/channel_colors: one per channel (default R, G, B; named channels are white)
 	# Note: to convert to OME, we need a tall, thin mono image with page-height set to
 	# indicate where the joins are. https://github.com/libvips/pyvips/issues/502
 	
+	temp_ome = ome_xml(file_output, dimension_order, dimension_sizes, pixel_size_sel, channel_names, channel_colors)
+
+	#stack vertically ready for OME 
+	montage_roll = pyvips.Image.arrayjoin(channel_list, across= 1) #for OME (only)
+	montage_roll = montage_roll.copy()
+	montage_roll.set_type(pyvips.GValue.gint_type, "page-height", dimension_sizes[1])			
+	montage_roll.set_type(pyvips.GValue.gstr_type, "image-description", temp_ome)
+
+	return montage_roll
+
+def ome_xml(file_output, dimension_order, dimension_sizes, pixel_size_sel, channel_names=None, channel_colors=None):
+	#OME-XML of a montage with one TIFF page per channel (see ready_for_OME)
+
 	filename_without_extension = os.path.splitext(file_output)[0]
 
 	size_x = dimension_sizes[0]
@@ -535,10 +1263,14 @@ def ready_for_OME(channel_list, file_output, dimension_order, dimension_sizes, p
 		type='uint8' #default pixel type
 		)
 
-	pixels.channels.extend([
-		Channel(color="-16777216", name="R", samples_per_pixel=1),
-		Channel(color="16711680", name="G", samples_per_pixel=1),
-		Channel(color="65280", name="B", samples_per_pixel=1)])				
+	if channel_names is None:
+		channel_names = ["R", "G", "B"]
+		channel_colors = RGB_COLORS
+	elif channel_colors is None:
+		channel_colors = ["-1"]*len(channel_names)
+
+	pixels.channels.extend([Channel(color= color, name= name, samples_per_pixel=1) 
+		for name, color in zip(channel_names, channel_colors)])				
 	
 	# file_output_info = f"montage_series{series}_z{z}.tif" #informative to QuPath
 	file_output_info = filename_without_extension #file_output (the extension is not an issue)
@@ -554,25 +1286,35 @@ def ready_for_OME(channel_list, file_output, dimension_order, dimension_sizes, p
 	) #file_name cannot change
 
 	pixels.tiff_data_blocks.append(tiff)
-	temp_ome = ome.to_xml() 							
 
-	#stack vertically ready for OME 
-	montage_roll = pyvips.Image.arrayjoin(channel_list, across= 1) #for OME (only)
-	montage_roll = montage_roll.copy()
-	montage_roll.set_type(pyvips.GValue.gint_type, "page-height", size_y)			
-	montage_roll.set_type(pyvips.GValue.gstr_type, "image-description", temp_ome)
+	return ome.to_xml()
 
-	return montage_roll
+def save_pyramid(montage_roll, output_path, tileSizeX, tileSizeY, compression, pyramid_workers=None):
+	#pyramid_workers: threads of the parallel writer (None= libvips tiffsave)
+	#other formats (e.g. float OME-TIFFs of zStack_montages) are written by tiffsave
+
+	if (pyramid_workers is not None) and parallel_available() and (montage_roll.format in ["uchar", "ushort"]):
+		write_pyramid(montage_roll, output_path, tileSizeX, tileSizeY, compression, pyramid_workers)
+	else:
+		montage_roll.tiffsave(output_path, compression= compression, tile=True, 
+					tile_width= tileSizeX, tile_height=tileSizeY,
+					pyramid=True, subifd=True, bigtiff=True) 
+		#output > 4 GB requires 64-bit big tiff format
 
 #endregion
 
 #region Join ray tracing tiles
 
-def join_rt_tiles_function(workingDir1, statistic_list, percentOut_dsaImage):
+def join_rt_tiles_function(workingDir1, statistic_list, percentOut_dsaImage, pool, rt_encoding="compact", rt_pack=False, pyramid_workers=None, rt_format="tiles"):
+	#rt_pack: one multi-channel OME-TIFF per modality and z plane with all statistics (named channels)
+	#rt_format: 'cube'= statistics read from their raw containers (one file per montage, see ray_tracing_function)
+	#One pool job per output file; libvips threads split so that jobs x threads ~ n_cores
 
 	#Output folder
 	path0 = os.path.join(workingDir1, 'montages_rt')
+	path3 = os.path.join(path0, 'stats') #stitched statistics (re-contrast)
 	mkdir2(path0)
+	mkdir2(path3)
 
 	#Recovering metadata	
 	path1 = os.path.join(workingDir1, 'experimental_metadata.json')
@@ -582,90 +1324,276 @@ def join_rt_tiles_function(workingDir1, statistic_list, percentOut_dsaImage):
 	with open(path1, 'r') as f:
 		data = json.load(f)
 
-	dimension_order = data["dimension_order"]
-	tileSizeX = data["tileSizeX"]
-	tileSizeY = tileSizeX	
-	pixel_size_sel = data["pixel_size_sel"]
-
 	#Processing metadata
 	df_rt = pd.read_csv(path2)
-	x_list = df_rt["x"].unique()
-	y_list = df_rt["y"].unique()
 	z_list = df_rt["z"].unique()	
 	modality_list = df_rt["modality"].unique()
 
 	if not statistic_list: #empty
 		statistic_list = df_rt["statistic"].unique()
 
-	tiles_accross = x_list.max() + 1 #assuming same pyramid level
+	#Indexed tile table (modality, statistic, z, y, x)
+	grid_rt, positions = tile_grid(df_rt, ['modality', 'statistic', 'z', 'y', 'x'])
+	modality_pos, statistic_pos, z_pos = positions[0], positions[1], positions[2]
 
-	#Loop (assuming no missing tiles)	
+	tiles_accross = grid_rt.shape[-1] #assuming same pyramid level
+	cell_size = (int(df_rt['width'].max()), int(df_rt['height'].max()))
+	grid_width, _ = tile_grid(df_rt, ['modality', 'statistic', 'z', 'y', 'x'], 'width')
+	grid_height, _ = tile_grid(df_rt, ['modality', 'statistic', 'z', 'y', 'x'], 'height')
+
+	#Resumable runs
+	manifest = RunManifest(workingDir1)
+	export_fp = export_fingerprint(data)
+	histograms = load_histograms(workingDir1) #merged while ray tracing
+
+	#Montages to write (assuming no missing tiles)	
+	jobs = []
 	for modality_str in modality_list:		
+		n_layers = modality_layers(data, modality_str)
 
-		for sel_stats in statistic_list:
-			
-			print(f"{modality_str} montage {sel_stats}")
-			condition = (sel_stats == "std") or (sel_stats == "minIndex") or (sel_stats == "maxIndex")			
+		for z in z_list:
 
-			for z in z_list:
+			#Inputs of each statistic montage
+			rt_fps = {}
+			montage_fps = {}
+			for sel_stats in statistic_list:
+				condition = sel_stats == "std" #contrast stretched (indexes use a fixed mapping)			
 				
-				idx1 = df_rt["z"] == z
-				idx2 = df_rt["statistic"] == sel_stats
-				idx3 = df_rt["modality"] == modality_str
-				idx = (idx1 & idx2 & idx3)
-				df_rt2 = df_rt.loc[idx, :] #shortened
+				rt_fps[sel_stats] = rt_fingerprint(export_fp, modality_str, sel_stats, rt_encoding, rt_format)
+				montage_fps[sel_stats] = fingerprint(rt_fps[sel_stats], (percentOut_dsaImage, "histogram") if condition else None)
+
+			#Output files (one per statistic, or one pack)
+			if rt_pack:
+				outputs = [(f"{modality_str}_stats_z{z}.tif", list(statistic_list), fingerprint(*[montage_fps[sel_stats] for sel_stats in statistic_list]))]
+			else:
+				outputs = [(f"{modality_str}_{sel_stats}_z{z}.tif", [sel_stats], montage_fps[sel_stats]) for sel_stats in statistic_list]
+
+			for file_output, statistic_list2, montage_fp in outputs:				
+				output_path = os.path.join(path0, file_output)
+
+				#Skip montages already written from the same inputs
+				key = f"montage/rt/{file_output}"
+				if manifest.is_done(key, montage_fp) and os.path.exists(output_path):
+					continue
+
+				parts = []
+				for sel_stats in statistic_list2:
+					idx = (modality_pos[modality_str], statistic_pos[sel_stats], z_pos[z])
+					
+					#Contrast thresholds (exact, from histograms)
+					name = f"{modality_str}_{sel_stats}_z{z}"
+					entry = histograms.get(name)
+					histogram = entry[0] if (entry is not None) and (entry[1] == rt_fps[sel_stats]) else None
+
+					width = int(grid_width[idx][0, :].sum()) #without the arrayjoin padding
+					height = int(grid_height[idx][:, 0].sum())
+					source = data["rt_cubes"][name] if rt_format == "cube" else grid_rt[idx]
+					parts.append((sel_stats, name, rt_fps[sel_stats], source, width, height, histogram))
+
+				jobs.append((data, parts, tiles_accross, cell_size, n_layers, output_path, key, montage_fp, percentOut_dsaImage, path3))
+
+	n_threads, pyramid_threads = montage_threads(pool.n_cores, len(jobs), pyramid_workers)
+	args = [item + (n_threads, pyramid_threads) for item in jobs]
+
+	#Recorded as each montage finishes (histograms and manifest written by this process only)
+	for key, montage_fp, stitched in pool.istarmap(join_rt_montage, args):
+		for name, histogram, rt_fp in stitched:
+			entry = histograms.get(name)
+			if (entry is None) or (entry[1] != rt_fp): #interrupted run
+				histograms[name] = (histogram, rt_fp)
+				save_histograms(histograms, workingDir1)
+
+			manifest.mark_done(f"stat/rt/{name}", rt_fp)
 		
-				image_tiles = []
-				for y in y_list:
-					for x in x_list:
-						idx4 = df_rt2["x"] == x
-						idx5 = df_rt2["y"] == y
-						idx_b = (idx4 & idx5)
+		manifest.mark_done(key, montage_fp)
+		manifest.flush()
 
-						path_temp = df_rt2.loc[idx_b, 'image_path'].array[0]
+	manifest.close()
 
-						#Load image
-						im_temp = pyvips.Image.new_from_file(path_temp)     #, access="sequential"					
+def join_rt_montage(data, parts, tiles_accross, cell_size, n_layers, output_path, key, montage_fp, percentOut_dsaImage, path3, n_threads, pyramid_workers=None):
+	#One montage file of one or more statistics (pool job)
+	#parts: [(statistic, name, rt_fp, tile paths (y, x) or container layout, width, height, histogram or None)]
+	#returns the stitched statistics (name, histogram, rt_fp) for the parent to record
 
-						image_tiles.append(im_temp)
-			
+	with vips_concurrency(n_threads): #restored for later jobs of this worker
+		montages = []
+		stitched = []
+		for sel_stats, name, rt_fp, source, width, height, histogram in parts:
+
+			print(f"{name} montage")
+			condition = sel_stats == "std"
+	
+			if isinstance(source, dict): #one raw container
+				image_stitched = load_raw(source, 0, tiles_accross, cell_size)
+
+			else:
+				image_paths = source.ravel() #row-wise
+
+				image_tiles = []
+				for path_temp in image_paths:
+
+					#Load image
+					im_temp = pyvips.Image.new_from_file(path_temp)     #, access="sequential"					
+
+					image_tiles.append(im_temp)
+		
 				#Build montage				
 				image_stitched = pyvips.Image.arrayjoin(image_tiles, across= tiles_accross)
-				
-				#Optional steps:
-				
-				if condition:						
-					#Rescale to uint8 (with extra computational cost)
-					montage = img_rescaled(image_stitched, percentOut_dsaImage)		
-				
-				else:
-					montage = channel_uint8(image_stitched)								
 
-				size_x = montage.width #image are of = XY size
-				size_y = montage.height
-				size_c = 3
-				
-				# #(1) Crop background borders
-				# left, top, width, height = image_stitched.find_trim(threshold=0.001, background=[0])
-				# image_stitched2 = image_stitched.crop(left, top, width, height) #modify accordingly  									
-				
-				#Save as pyramidal OME-TIFF			
-				file_output = f"{modality_str}_{sel_stats}_z{z}.tif"
-				output_path = os.path.join(path0, file_output)
-				
-				dimension_sizes = [size_x, size_y, size_c, 1, 1] #[X, Y, C, Z, T]				
-				montage_roll = ready_for_OME(montage.bandsplit(), file_output, dimension_order, dimension_sizes, pixel_size_sel)
+			if condition and (histogram is None) and (image_stitched.format in ["uchar", "ushort"]):
+				#interrupted run: one streaming pass (without the arrayjoin padding)
+				histogram = montage_histogram(image_stitched.crop(0, 0, width, height))
+
+			#Statistic stitched once (stored precision), so contrast can be redone from one file
+			if histogram is not None:
+				stat_path = os.path.join(path3, f"{name}.tif")
+				image_stitched.tiffsave(stat_path, compression="lzw", predictor="horizontal", tile=True, bigtiff=True)
+				stitched.append((name, histogram, rt_fp))
+
+				image_stitched = pyvips.Image.new_from_file(stat_path)
+		
+			montage, channel_names = rt_montage_uint8(image_stitched, sel_stats, percentOut_dsaImage, histogram, n_layers)
+			montages.append((sel_stats, montage, channel_names))
+
+		#One pyramid pass for all the channels
+		write_montage_pyramid(montages, output_path, data, pyramid_workers)
 
-				montage_roll.tiffsave(output_path, compression="lzw", tile=True, 
-							tile_width= tileSizeX, tile_height=tileSizeY,
-							pyramid=True, subifd=True, bigtiff=True) 
-				#output > 4 GB requires 64-bit big tiff format
+		return key, montage_fp, stitched
+
+def modality_layers(data, modality_str):
+	#Number of angles (layers) of a modality
+
+	return len([layer for layer in data["layer_names"] if layer.find(modality_str) != -1])
+
+def recontrast_rt_function(workingDir1, percentOut_dsaImage, pyramid_workers=None, rt_pack=False):
+	#Re-renders the contrast-stretched montages (std) from the stitched statistics and cached
+	#histograms of the last join: one streamed linear map and pyramid write per montage (unpacked output)
+
+	if rt_pack:
+		#packs also hold statistics that are not stored stitched (rebuilt by the montage step)
+		print("Re-contrast skipped: packed output (rt_pack) is rebuilt by running the montage step with the new percentile.")
+		return
+
+	path0 = os.path.join(workingDir1, 'montages_rt')
+	path3 = os.path.join(path0, 'stats')
+
+	#Recovering metadata	
+	path1 = os.path.join(workingDir1, 'experimental_metadata.json')
+
+	#JSON
+	with open(path1, 'r') as f:
+		data = json.load(f)
+
+	manifest = RunManifest(workingDir1)
+	histograms = load_histograms(workingDir1)
+
+	for name, (histogram, rt_fp) in sorted(histograms.items()):
+		
+		stat_path = os.path.join(path3, f"{name}.tif")
+		if not (manifest.is_done(f"stat/rt/{name}", rt_fp) and os.path.exists(stat_path)):
+			print(f"{name}: no stitched statistic (run the montage step first)")
+			continue
+
+		_, sel_stats, _ = name.rsplit("_", 2) #modality, statistic, z
+		if sel_stats != "std": #index histograms of earlier runs
+			continue
+
+		file_output = f"{name}.tif"
+		output_path = os.path.join(path0, file_output)
+
+		#Skip montages already rendered with this percentile
+		key = f"montage/rt/{file_output}"
+		montage_fp = fingerprint(rt_fp, (percentOut_dsaImage, "histogram"))
+		if manifest.is_done(key, montage_fp) and os.path.exists(output_path):
+			continue
+
+		print(f"{name} re-contrast")
+		image_stitched = pyvips.Image.new_from_file(stat_path)
+		write_rt_montage(image_stitched, sel_stats, output_path, data, percentOut_dsaImage, histogram, pyramid_workers= pyramid_workers)
+
+		manifest.mark_done(key, montage_fp)
+		manifest.flush()
+
+	manifest.close()
+
+def write_rt_montage(image_stitched, sel_stats, output_path, data, percentOut_dsaImage, histogram=None, n_layers=None, pyramid_workers=None):
+	#uint8 conversion and pyramidal OME-TIFF of one statistic montage (tile and vips engines)
+
+	montage, channel_names = rt_montage_uint8(image_stitched, sel_stats, percentOut_dsaImage, histogram, n_layers)
+	write_montage_pyramid([(sel_stats, montage, channel_names)], output_path, data, pyramid_workers)
+
+def rt_montage_uint8(image_stitched, sel_stats, percentOut_dsaImage, histogram=None, n_layers=None):
+	#uint8 montage of one statistic and its channel names (None= RGB)
+	#histogram: merged (n_channels, bins) histogram of integer statistics (exact thresholds)
+	#n_layers: index montages are single channel, grey = index*index_step(n_layers)
+
+	#Optional steps:
+	condition = sel_stats == "std"			
+	channel_names = None #RGB
+	
+	if sel_stats in ["maxIndex", "minIndex"]:
+		#Fixed mapping, no percentile pass (tiles of earlier runs repeat the index in 3 channels)
+		step = index_step(n_layers)
+		montage = (image_stitched[0] * step).cast("uchar")
+		channel_names = [f"{sel_stats} (x{step})"]
+
+	elif condition and (histogram is not None):
+		montage = img_rescaled_hist(image_stitched, histogram, percentOut_dsaImage)
+
+	elif condition:						
+		#Rescale to uint8 (with extra computational cost)
+		montage = img_rescaled(image_stitched, percentOut_dsaImage)		
+	
+	else:
+		montage = channel_uint8(image_stitched)								
+
+	# #(1) Crop background borders
+	# left, top, width, height = image_stitched.find_trim(threshold=0.001, background=[0])
+	# image_stitched2 = image_stitched.crop(left, top, width, height) #modify accordingly  									
+
+	return montage, channel_names
+
+def write_montage_pyramid(montages, output_path, data, pyramid_workers=None):
+	#montages: [(statistic, uint8 montage, channel names)] written as channels of one pyramidal OME-TIFF
+
+	file_output = os.path.basename(output_path)
+	dimension_order = data["dimension_order"]
+	tileSizeX = data["tileSizeX"]
+	tileSizeY = tileSizeX	
+	pixel_size_sel = data["pixel_size_sel"]
+
+	channel_list = []
+	channel_names = []
+	channel_colors = []
+	for sel_stats, montage, names in montages:
+		channel_list.extend(montage.bandsplit())
+
+		if names is None: #RGB
+			channel_names.extend([f"{sel_stats} {band}" for band in ["R", "G", "B"]])
+			channel_colors.extend(RGB_COLORS)
+		else:
+			channel_names.extend(names)
+			channel_colors.extend(["-1"]*len(names))
+
+	if (len(montages) == 1) and (montages[0][2] is None):
+		channel_names, channel_colors = None, None #single RGB montage
+
+	size_x = channel_list[0].width #image are of = XY size
+	size_y = channel_list[0].height
+	size_c = len(channel_list)
+	
+	#Save as pyramidal OME-TIFF			
+	dimension_sizes = [size_x, size_y, size_c, 1, 1] #[X, Y, C, Z, T]				
+	montage_roll = ready_for_OME(channel_list, file_output, dimension_order, dimension_sizes, pixel_size_sel, channel_names, channel_colors)
+
+	save_pyramid(montage_roll, output_path, tileSizeX, tileSizeY, "lzw", pyramid_workers)
 
 #endregion
 
 #region Join original tiles
 
-def join_original_tiles_function(workingDir1, conditions):
+def join_original_tiles_function(workingDir1, conditions, pool, pyramid_workers=None):
+	#One pool job per (series, z) montage; libvips threads split so that jobs x threads ~ n_cores
 
 	#Output folder
 	path0 = os.path.join(workingDir1, 'montages_original')
@@ -678,80 +1606,199 @@ def join_original_tiles_function(workingDir1, conditions):
 	with open(path1, 'r') as f:
 		data = json.load(f)
 
-	dimension_order = data["dimension_order"]
-	tileSizeX = data["tileSizeX"]
-	tileSizeY = data["tileSizeY"]	
-	pixel_size_sel = data["pixel_size_sel"]	
 	layer_names = data["layer_names"]
 	series_list = data["series_span"]	
 
-	#Remembering tile arrangement
-	fileList = glob.glob(f"{workingDir1}/**/**/*.tif", recursive = False) #only in current dir 	
-	pattern = re.compile(r".+\\series(\d+)_z(\d+)\\tile_x(\d+)_y(\d+)\.tif")	
-	
-	df1	= understand_tiling(fileList, pattern, workingDir1)	
+	#Remembering tile arrangement (manifest written at export)
+	df1	= load_tiling(workingDir1)	
 		
 	z_list = df1['z'].unique()	
-	x_list = df1["x"].unique()
-	y_list = df1['y'].unique()
-	tiles_accross = x_list.max() + 1 #assuming same pyramid level
 
-	#Loop (assuming no missing tiles)
+	#Indexed tile table (series, z, y, x)
+	grid1, positions = tile_grid(df1, ['series', 'z', 'y', 'x'])
+	series_pos, z_pos = positions[0], positions[1]
+
+	tiles_accross = grid1.shape[-1] #assuming same pyramid level
+	cell_size = (int(df1['width'].max()), int(df1['height'].max()))
+
+	#Resumable runs
+	manifest = RunManifest(workingDir1)
+	export_fp = export_fingerprint(data)
+
+	#Montages to write (assuming no missing tiles)
+	jobs = []
 	for series, layer_name in zip(series_list, layer_names):
 		for z in z_list:
-			
-			#info
-			idx1 = df1['series'] == series
-			idx2 = df1['z'] == z
-			idx = idx1 & idx2
 
-			df2 = df1.loc[idx, :] #df			
+			file_output = layer_name + f"_z{z}.tif"
+			output_path = os.path.join(path0, file_output)
 
-			image_tiles = []
-			for y in y_list:
-				for x in x_list:
-					idx3 = df2['x'] == x
-					idx4 = df2['y'] == y
-					idx_b = idx3 & idx4
-					path_temp = df2.loc[idx_b, 'image_path'].array[0]
+			#Skip montages already written from the same inputs
+			key = f"montage/original/{file_output}"
+			montage_fp = fingerprint(export_fp, series, z)
+			if manifest.is_done(key, montage_fp) and os.path.exists(output_path):
+				continue
 
-					#Load image
-					im_temp = pyvips.Image.new_from_file(path_temp)    					  			
+			jobs.append((data, grid1[series_pos[series], z_pos[z]], series, z, tiles_accross, cell_size, output_path, key, montage_fp))
 
-					image_tiles.append(im_temp)
-			
-			#Build montage
-			
-			image_stitched = pyvips.Image.arrayjoin(image_tiles, across= tiles_accross)
-			
-			#Optional steps:	
-			montage = channel_uint8(image_stitched)			
+	n_threads, pyramid_threads = montage_threads(pool.n_cores, len(jobs), pyramid_workers)
+	args = [item + (n_threads, pyramid_threads) for item in jobs]
+
+	#Recorded as each montage finishes
+	for key, montage_fp in pool.istarmap(join_original_montage, args):
+		manifest.mark_done(key, montage_fp)
+		manifest.flush()
+
+	manifest.close()
+
+def join_original_montage(data, grid_paths, series, z, tiles_accross, cell_size, output_path, key, montage_fp, n_threads, pyramid_workers=None):
+	#One (series, z) montage (pool job)
+
+	with vips_concurrency(n_threads): #restored for later jobs of this worker
+		file_output = os.path.basename(output_path)
+		dimension_order = data["dimension_order"]
+		tileSizeX = data["tileSizeX"]
+		tileSizeY = data["tileSizeY"]	
+		pixel_size_sel = data["pixel_size_sel"]	
+	
+		#Build montage
+		image_stitched = load_montage(data, grid_paths, series, z, tiles_accross, cell_size)
+	
+		#Optional steps:	
+		montage = channel_uint8(image_stitched)			
+
+		size_x = montage.width #image are of = XY size
+		size_y = montage.height
+		size_c = 3
+
+		#(1) Crop background borders
+		# left, top, width, height = image_stitched.find_trim(threshold=0.001, background=[0])
+		# montage = image_stitched.crop(left, top, width, height) #modify accordingly								
+
+		#Save as pyramidal OME-TIFF			
+		dimension_sizes = [size_x, size_y, size_c, 1, 1] #[size_c, size_z, size_t]
+		montage_roll = ready_for_OME(montage.bandsplit(), file_output, dimension_order, dimension_sizes, pixel_size_sel)
+		#optional: add QuPath information allowing to pass filename 'series'			
+
+		save_pyramid(montage_roll, output_path, tileSizeX, tileSizeY, "jpeg", pyramid_workers)
+
+		return key, montage_fp
+
+def transcode_original_function(image_path, sel_level, tileSize, pool, conditions, pyramid_workers=None):
+	#Originals without the 'bf_tiles' export: each (series, z) is read by Bio-Formats in tile rows and 
+	#streamed into its pyramidal OME-TIFF (same montages as save_tiles_function + join_original_tiles_function)
+
+	#Folder convention
+	dirname1 = os.path.dirname(image_path)
+	basename1 = os.path.basename(image_path).replace(".vsi", "")
+	workingDir1 = os.path.join(dirname1, "processed_" + basename1)
+
+	if not parallel_available():
+		print("Direct transcode requires tifffile and imagecodecs (exporting tiles instead).")
+		save_tiles_function(image_path, sel_level, tileSize, pool, conditions)
+		join_original_tiles_function(workingDir1, conditions, pool, pyramid_workers)
+		return
+
+	#Output folder
+	path0 = os.path.join(workingDir1, 'montages_original')
+	mkdir2(path0)
+
+	data = save_process_metadata(image_path, sel_level, tileSize, conditions, "direct")
+
+	df_sizes = pd.read_csv(os.path.join(workingDir1, 'pyramid_sizes.csv'), sep=',')
+
+	#Resumable runs
+	manifest = RunManifest(workingDir1)
+	export_fp = export_fingerprint(data)
 
-			size_x = montage.width #image are of = XY size
-			size_y = montage.height
-			size_c = 3
+	#Montages to write
+	jobs = []
+	for series, layer_name in zip(data["series_span"], data["layer_names"]):
+		idx = df_sizes['series'] == series
+		image_count = int(df_sizes.loc[idx, 'imageCount'].array[0])
 
-			#(1) Crop background borders
-			# left, top, width, height = image_stitched.find_trim(threshold=0.001, background=[0])
-			# montage = image_stitched.crop(left, top, width, height) #modify accordingly								
+		for z in range(image_count):
 
-			#Save as pyramidal OME-TIFF			
 			file_output = layer_name + f"_z{z}.tif"
 			output_path = os.path.join(path0, file_output)
-			
-			dimension_sizes = [size_x, size_y, size_c, 1, 1] #[size_c, size_z, size_t]
-			montage_roll = ready_for_OME(montage.bandsplit(), file_output, dimension_order, dimension_sizes, pixel_size_sel)
-			#optional: add QuPath information allowing to pass filename 'series'			
 
-			montage_roll.tiffsave(output_path, compression="jpeg", tile=True, 
-						tile_width= tileSizeX, tile_height=tileSizeY,
-						pyramid=True, subifd=True, bigtiff=True)
+			#Skip montages already written from the same inputs
+			key = f"montage/original/{file_output}"
+			montage_fp = fingerprint(export_fp, series, z)
+			if manifest.is_done(key, montage_fp) and os.path.exists(output_path):
+				continue
+
+			jobs.append((image_path, data, series, z, output_path, key, montage_fp))
+
+	#Pyramid writer threads (required here)
+	_, pyramid_threads = montage_threads(pool.n_cores, len(jobs), pool.n_cores if pyramid_workers is None else pyramid_workers, prefetch= False)
+	args = [item + (pyramid_threads,) for item in jobs]
+
+	#Recorded as each montage finishes
+	for key, montage_fp in pool.istarmap(transcode_original_montage, args):
+		manifest.mark_done(key, montage_fp)
+		manifest.flush()
+
+	manifest.close()
+
+def transcode_original_montage(image_path, data, series, z, output_path, key, montage_fp, pyramid_workers):
+	#One (series, z) montage (pool job): Bio-Formats strips -> pyramid writer, bounded memory
+	#(one tile row in memory; channels 1.. of each row wait in a scratch file for their pages)
+
+	#Default
+	sizeC = 3 #for optical microscopy
+
+	tileSizeX = data["tileSizeX"]
+	tileSizeY = data["tileSizeY"]
+
+	#Reader (cached in this worker)
+	reader, _ = get_reader(image_path)
+
+	reader.setSeries(series)
+	sizeX = reader.getSizeX()
+	sizeY = reader.getSizeY()
+
+	#Padded to whole tiles (same montage size as the arrayjoin of exported tiles)
+	width = int(math.ceil(sizeX / tileSizeX)) * min(tileSizeX, sizeX)
+	height = int(math.ceil(sizeY / tileSizeY)) * min(tileSizeY, sizeY)
+
+	file_output = os.path.basename(output_path)
+	dimension_sizes = [width, height, sizeC, 1, 1] #[X, Y, C, Z, T]
+	description = ome_xml(file_output, data["dimension_order"], dimension_sizes, data["pixel_size_sel"])
+
+	spill_path = output_path + ".channels.tmp"
+	spill = np.memmap(spill_path, dtype= np.uint8, mode= 'w+', shape= (sizeC - 1, height, width))
+
+	def read_strip(page, y0, rows):
+		if page > 0:
+			return spill[page - 1, y0:y0 + rows]
+
+		#One Bio-Formats read per tile row (interleaved)
+		strip = np.zeros((rows, width, sizeC), dtype= np.uint8)
+		rows_read = min(rows, sizeY - y0)
+		if rows_read > 0:
+			buf = reader.openBytesXYWH(z, 0, y0, sizeX, rows_read)
+			buf.shape = (rows_read, sizeX, sizeC) #interleaved (see VSI metadata)
+			strip[:rows_read, :sizeX] = buf
+
+		spill[:, y0:y0 + rows] = np.moveaxis(strip[:, :, 1:], 2, 0)
+
+		return np.ascontiguousarray(strip[:, :, 0])
+
+	try:
+		write_pyramid_strips(read_strip, (sizeC, height, width), np.uint8, output_path, tileSizeX, tileSizeY, "jpeg", 
+							 pyramid_workers, description, prefetch= False) #reader bound to this thread
+	finally:
+		spill._mmap.close()
+		os.remove(spill_path)
+
+	return key, montage_fp
 
 #endregion
 
 #region Z-stack
 
-def zStack_montages(fileList2, pixel_size_sel, tileSize, output_path):
+def zStack_montages(fileList2, pixel_size_sel, tileSize, output_path, pyramid_workers=None):
 
 	filename_with_extension = os.path.basename(output_path)	
 	file_output = filename_with_extension #requirement
@@ -812,8 +1859,6 @@ def zStack_montages(fileList2, pixel_size_sel, tileSize, output_path):
 	montage_roll = ready_for_OME(channel_list, file_output, dimension_order, dimension_sizes, pixel_size_sel)
 	
 	# print('Writing pyramid.')	
-	montage_roll.tiffsave(output_path, compression="lzw", tile=True, 
-				tile_width= tileSizeX, tile_height=tileSizeY,
-				pyramid=True, subifd=True, bigtiff=True) #"lzw"
+	save_pyramid(montage_roll, output_path, tileSizeX, tileSizeY, "lzw", pyramid_workers)
 	
 #endregion
\ No newline at end of file
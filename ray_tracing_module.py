@@ -18,6 +18,7 @@ Date updated: 3-Sep-25, 13-Sep-25
 
 import os
 import sys
+import functools
 import numpy as np
 import pandas as pd
 
@@ -119,28 +120,94 @@ def img_rescaled(image_cropped, percentOut_dsaImage):
 
 	return image_rescaled
 
-def understand_tiling(fileList, pattern, workingDir1):
+#Histograms (exact contrast thresholds without re-reading the montage)
+HISTOGRAM_BINS = 65536 #uint8 and uint16 statistic tiles
+
+def tile_histograms(tile_temp2):
+	#Sparse per-channel histograms of an integer statistic tile: [(codes, counts)]
 	
-	items_str = ['series', 'z', 'x', 'y', 'width', 'height', 'image_path']
+	histograms = []
+	for i in range(tile_temp2.shape[2]):
+		counts = np.bincount(tile_temp2[:, :, i].ravel(), minlength= 1)
+		codes = np.flatnonzero(counts)
+		histograms.append((codes.astype(np.uint16), counts[codes]))
+
+	return histograms
+
+def merge_histograms(histogram, histograms_tile):
+	#Adds sparse tile histograms into a dense (n_channels, HISTOGRAM_BINS) montage histogram
 	
-	values = []
-	for filename in fileList:		
-		match = pattern.match(filename) # scan image set (perfect match needed)      
-		
-		if match is None:
-			continue
+	if histogram is None:
+		histogram = np.zeros((len(histograms_tile), HISTOGRAM_BINS), dtype= np.int64)
+
+	for i, (codes, counts) in enumerate(histograms_tile):
+		histogram[i, codes] += counts
+
+	return histogram
+
+def histogram_thresholds(histogram_channel, percentOut_dsaImage):
+	#First codes reaching p and 100-p percent of the pixels (as pyvips percent)
+
+	cumulative = np.cumsum(histogram_channel)
+	total = cumulative[-1]
+
+	th_low = int(np.searchsorted(cumulative, total * percentOut_dsaImage / 100))
+	th_high = int(np.searchsorted(cumulative, total * (100 - percentOut_dsaImage) / 100))
+	th_high = max(th_high, th_low + 1) #flat channels
 
-		item_series = int(match.group(1))
-		item_z = int(match.group(2))    
-		item_x = int(match.group(3))    
-		item_y = int(match.group(4))
+	return th_low, th_high
 
-		#image size
-		im_temp = pyvips.Image.new_from_file(filename) #must be an image
-		item_width = im_temp.width
-		item_height = im_temp.height
+def img_rescaled_hist(image_stitched, histogram, percentOut_dsaImage):
+	#img_rescaled with thresholds from the merged montage histogram (no thumbnail or stats pass)
 
-		values.append([item_series, item_z, item_x, item_y, item_width, item_height, filename])
+	channel_list_out = []
+	for i in range(image_stitched.bands):
+		th_low_input, th_high_input = histogram_thresholds(histogram[i], percentOut_dsaImage)
+		channel_list_out.append(channel_rescaled(image_stitched[i], th_low_input, th_high_input))
+
+	#RGB
+	image_rescaled = channel_list_out[0].bandjoin(channel_list_out[1:])
+
+	return image_rescaled
+
+def montage_histogram(image):
+	#Per-band histogram of an integer (uchar/ushort) image in one streaming pass
+
+	histogram = image.hist_find().numpy().reshape(-1, image.bands).T
+	
+	return np.pad(histogram, ((0, 0), (0, HISTOGRAM_BINS - histogram.shape[1]))).astype(np.int64)
+
+def load_histograms(workingDir1):
+	#Merged montage histograms ('histograms_rt.npz'): {name: (histogram, fingerprint)}
+
+	path = os.path.join(workingDir1, 'histograms_rt.npz')
+	
+	histograms = {}
+	if os.path.exists(path):
+		with np.load(path) as f:
+			for name in f.files:
+				if not name.endswith('_fp'):
+					histograms[name] = (f[name], str(f[name + '_fp']))
+
+	return histograms
+
+def save_histograms(histograms, workingDir1):
+
+	path = os.path.join(workingDir1, 'histograms_rt.npz')
+	
+	arrays = {}
+	for name, (histogram, fp) in histograms.items():
+		arrays[name] = histogram
+		arrays[name + '_fp'] = np.array(fp)
+
+	with open(path + '.tmp', 'wb') as f: #replaced in one step (interrupted runs)
+		np.savez(f, **arrays)
+	os.replace(path + '.tmp', path)
+
+def save_tiling(values, workingDir1):
+	#Tile manifest emitted by the exporter ('files1.csv')
+	
+	items_str = ['series', 'z', 'x', 'y', 'width', 'height', 'image_path']
 
 	df = pd.DataFrame(values, columns = items_str)	
 	df1 = df.sort_values(items_str, ascending= [True, True, True, True, True, True, True])
@@ -149,51 +216,408 @@ def understand_tiling(fileList, pattern, workingDir1):
 	
 	return df1
 
+def load_tiling(workingDir1):
+	#Reads the manifest without touching the tile files (same on Linux and Windows)
+
+	df1 = pd.read_csv(os.path.join(workingDir1, 'files1.csv'))
+
+	return df1
+
+def tile_grid(df, keys, column='image_path'):
+	#Dense array (keys...) of one tile table column, built once for O(1) lookups
+	#e.g. keys= ['series', 'z', 'y', 'x'] gives grid[series_idx, z_idx] as a (y, x) tile array
+
+	levels = [np.sort(df[key].unique()) for key in keys]
+	codes = tuple(np.searchsorted(level, df[key].to_numpy()) for level, key in zip(levels, keys))
+	shape = tuple(len(level) for level in levels)
+
+	grid = np.empty(shape, dtype= object) #None= missing tile
+	grid[codes] = df[column].to_numpy()
+
+	#value to position (per key)
+	positions = [{value: i for i, value in enumerate(level.tolist())} for level in levels]
+
+	return grid, positions
+
 def calculate_statistic(tile_temp, sel_stats):
+	#Reference (whole angle stack): the pipeline uses StatisticAccumulator
 
-	condition_1 = sel_stats == "max"
-	condition_2 = sel_stats == "maxIndex"
-	condition_3 = sel_stats == "min"
-	condition_4 = sel_stats == "minIndex"	
-	condition_a = (condition_1 or condition_2 or condition_3 or condition_4)	
+	statistics = calculate_statistics(tile_temp, [sel_stats])
+	tile_temp2 = statistics.get(sel_stats)
 
-	#Using colour (float32)
-	if sel_stats == "mean":            
-		tile_temp2 = np.mean(tile_temp, axis= 3)
-		
-	elif sel_stats == "median":        
-		tile_temp2 = np.median(tile_temp, axis= 3)    
+	return tile_temp2
 
-	elif sel_stats == "std":        
-		tile_temp2 = np.std(tile_temp, axis= 3)    
+#Intermediate encodings of the statistic tiles ('rt_' folders)
+STD_SCALE = 256 #compact std: uint16 = round(256*std), std <= 127.5 for uint8 input
+
+def encode_statistic(tile_temp2, sel_stats, rt_encoding):
+	#'float32': as calculated (uint8 max/min/indexes for integer input, float32 otherwise)
+	#'compact': uint8 max/min/mean/median (truncated, as channel_uint8 at the join), 
+	#uint8/uint16 indexes and scaled uint16 std (the contrast stretch is scale invariant)
+	
+	if (rt_encoding == "float32") or not np.issubdtype(tile_temp2.dtype, np.floating):
+		return tile_temp2
 	
-	#Using greyscale indexes (int64)  
-	elif condition_a:
-		dim = tile_temp.shape
-		n_channels = dim[2]		
+	if sel_stats == "std":
+		return np.clip(np.rint(tile_temp2 * STD_SCALE), 0, 65535).astype(np.uint16)
+	elif sel_stats in ["maxIndex", "minIndex"]:
+		return tile_temp2.astype(np.uint16)
+	else:
+		return np.clip(tile_temp2, 0, 255).astype(np.uint8)
 
-		tile_greyscale = np.mean(tile_temp, axis= 2, keepdims=True)
-		
-		if condition_1 or condition_2:
-			tile_idx = np.argmax(tile_greyscale, axis= 3)
-		elif condition_3 or condition_4:
-			tile_idx = np.argmin(tile_greyscale, axis= 3)		
+def statistic_formats(statistic_list, n_layers, sizeC, rt_encoding, dtype=np.uint8):
+	#(dtype, channels) of each encoded statistic tile, from a 1-pixel angle stack
+	#(preallocates ray tracing containers before the tiles are computed)
+
+	accumulator = StatisticAccumulator(statistic_list, n_layers)
+	for _ in range(n_layers):
+		accumulator.update(np.zeros((1, 1, sizeC), dtype= dtype))
+
+	formats = {}
+	for sel_stats, tile_temp2 in accumulator.result().items():
+		tile_encoded = encode_statistic(tile_temp2, sel_stats, rt_encoding)
+		formats[sel_stats] = (tile_encoded.dtype.name, tile_encoded.shape[2])
+
+	return formats
+
+def index_step(n_layers):
+	#Fixed index-to-grey mapping of index montages (grey = index*step, up to 255)
+
+	return max(1, 255 // max(1, n_layers - 1))
+
+def index_dtype(n_layers):
+	#Smallest unsigned integer holding angle indexes
+	
+	return np.uint8 if n_layers <= 256 else np.uint16
+
+def greyscale_sum(tile_temp):
+	#Integer greyscale criterion (channel sum): same ranking as the float channel mean
+	
+	grey_type = np.uint16 if tile_temp.dtype.itemsize == 1 else np.uint32
+
+	return np.sum(tile_temp, axis= 2, dtype= grey_type)
+
+@functools.lru_cache(maxsize=None)
+def median_network(n_layers):
+	#Batcher odd-even merge sort comparators (padded to a power of 2; comparators 
+	#touching the padding are no-ops), pruned to those reaching the median position(s)
+	
+	n_padded = 1
+	while n_padded < n_layers:
+		n_padded = 2*n_padded
+
+	pairs = []
+	p = 1
+	while p < n_padded:
+		k = p
+		while k >= 1:
+			for j in range(k % p, n_padded - k, 2*k):
+				for i in range(min(k, n_padded - j - k)):
+					if (i + j)//(2*p) == (i + j + k)//(2*p):
+						a, b = i + j, i + j + k
+						if b < n_layers:
+							pairs.append((a, b))
+			k = k//2
+		p = 2*p
+
+	#backward pass (only comparators that can move a value into the median)
+	if n_layers % 2:
+		needed = {n_layers//2}
+	else:
+		needed = {n_layers//2 - 1, n_layers//2}
+	
+	pairs_kept = []
+	for a, b in reversed(pairs):
+		if (a in needed) or (b in needed):
+			pairs_kept.append((a, b))
+			needed.update((a, b))
+	
+	return tuple(reversed(pairs_kept))
+
+def median_planes(stack):
+	#Exact median across angles for integer (uint8) data, stack: (n_layers, ...) planes.
+	#Elementwise min/max over whole planes (selection network) instead of sorting each pixel.
+	#Matches np.median on float32: middle value, or the float32 mean of the two middle values.
+
+	n_layers = stack.shape[0]
+	planes = [stack[i].copy() for i in range(n_layers)]
+	temp = np.empty_like(planes[0])
+
+	for a, b in median_network(n_layers):
+		np.minimum(planes[a], planes[b], out= temp)
+		np.maximum(planes[a], planes[b], out= planes[b])
+		planes[a], temp = temp, planes[a]
+
+	if n_layers % 2:
+		tile_median = planes[n_layers//2].astype(np.float32)
+	else:
+		tile_median = (planes[n_layers//2 - 1].astype(np.float32) + planes[n_layers//2]) / 2
+
+	return tile_median
+
+def calculate_statistics(tile_temp, statistic_list):
+	#All requested statistics from one angle stack (tile_h, tile_w, n_channels, n_layers)
+	#Reference implementation of StatisticAccumulator (checked in benchmarks/benchmark_statistics.py)
+	#uint8/uint16 stacks use integer kernels for max/min/indexes (float only for mean/std/median)
+
+	n_layers = tile_temp.shape[3]
+	integer_input = np.issubdtype(tile_temp.dtype, np.integer)
+
+	tile_greyscale = None #shared by max/min and their indexes	
+	tile_indexes = {} #argmax/argmin computed once each
+	
+	statistics = {}
+	for sel_stats in statistic_list:
+
+		condition_1 = sel_stats == "max"
+		condition_2 = sel_stats == "maxIndex"
+		condition_3 = sel_stats == "min"
+		condition_4 = sel_stats == "minIndex"	
+		condition_a = (condition_1 or condition_2 or condition_3 or condition_4)	
+
+		#Using colour (float32)
+		if sel_stats == "mean":            
+			tile_temp2 = np.mean(tile_temp, axis= 3, dtype= np.float32)
+			
+		elif sel_stats == "median":        
+			if integer_input:
+				tile_temp2 = median_planes(np.moveaxis(tile_temp, 3, 0))
+			else:
+				tile_temp2 = np.median(tile_temp, axis= 3)    
+
+		elif sel_stats == "std":        
+			tile_temp2 = np.std(tile_temp, axis= 3, dtype= np.float32)    
 		
-		tile_idx2 = np.repeat(tile_idx, n_channels, 2) 			
+		#Using greyscale indexes  
+		elif condition_a:
+			
+			if tile_greyscale is None:
+				if integer_input:
+					tile_greyscale = greyscale_sum(tile_temp) #(tile_h, tile_w, n_layers)
+				else:
+					tile_greyscale = np.mean(tile_temp, axis= 2)
+			
+			direction = "max" if (condition_1 or condition_2) else "min"
+			if direction not in tile_indexes:
+				if direction == "max":
+					tile_indexes[direction] = np.argmax(tile_greyscale, axis= 2)
+				else:
+					tile_indexes[direction] = np.argmin(tile_greyscale, axis= 2)
+			tile_idx = tile_indexes[direction] #(tile_h, tile_w)
+			
+			#for index image
+			if condition_2 or condition_4:					
+				
+				idx_type = index_dtype(n_layers) if integer_input else np.float32
+				tile_temp2 = tile_idx.astype(idx_type)[:, :, np.newaxis] #single channel
+			
+			#for min/max (gather, no full-size index grids)
+			elif condition_1 or condition_3:							
+				
+				tile_temp2 = np.take_along_axis(tile_temp, tile_idx[:, :, np.newaxis, np.newaxis], axis= 3)[:, :, :, 0]
+
+		else:
+			print(f'The statistic selected ({sel_stats}) is not available')
+			continue
 		
-		#for index image
-		if condition_2 or condition_4:					
+		statistics[sel_stats] = tile_temp2
+	
+	return statistics
+
+class StatisticAccumulator:
+	#Streaming (online) statistics: angle tiles are folded one at a time, so the
+	#(tile_h, tile_w, n_channels, n_layers) stack is never allocated.
+	#Welford mean/variance, running max/min (greyscale criterion) with their indexes,
+	#and a native-dtype (uint8) angle stack only when the median is requested.
+	#Integer tiles keep max/min/indexes integer (float only for mean/std/median).
+
+	def __init__(self, statistic_list, n_layers):
 		
-			tile_temp2 = tile_idx2.astype(np.float32)   			
+		self.statistic_list = list(statistic_list)
+		self.n_layers = n_layers
+		self.count = 0
+
+		self.use_moments = any(item in ["mean", "std"] for item in self.statistic_list)
+		self.use_max = any(item in ["max", "maxIndex"] for item in self.statistic_list)
+		self.use_min = any(item in ["min", "minIndex"] for item in self.statistic_list)
+		self.use_median = "median" in self.statistic_list
+
+		#Allocated on first tile (when the shape is known)
+		self.integer_input = None
+		self.mean = None
+		self.M2 = None
+		self.max_grey = None
+		self.max_val = None
+		self.max_idx = None
+		self.min_grey = None
+		self.min_val = None
+		self.min_idx = None
+		self.median_stack = None
+
+	def update(self, tile):
+		#tile: (tile_h, tile_w, n_channels) of one angle, in acquisition order
+
+		i = self.count
+
+		if i == 0:
+			self.integer_input = np.issubdtype(tile.dtype, np.integer)
 		
-		#for min/max
-		elif condition_1 or condition_3:							
+		if not self.integer_input:
+			tile = tile.astype(np.float32, copy=False)		
+
+		if self.use_max or self.use_min:
+			if self.integer_input:
+				tile_greyscale = greyscale_sum(tile[:, :, :, np.newaxis])[:, :, 0]
+			else:
+				tile_greyscale = np.mean(tile, axis= 2) #same criterion as calculate_statistics
+
+		if i == 0:
+			shape = tile.shape
+			idx_type = index_dtype(self.n_layers)
+			if self.use_moments:
+				self.mean = np.zeros(shape, dtype= np.float64)
+				self.M2 = np.zeros(shape, dtype= np.float64)
+			if self.use_max:
+				self.max_grey = tile_greyscale.copy()
+				self.max_val = tile.copy()
+				self.max_idx = np.zeros(shape[:2], dtype= idx_type)
+			if self.use_min:
+				self.min_grey = tile_greyscale.copy()
+				self.min_val = tile.copy()
+				self.min_idx = np.zeros(shape[:2], dtype= idx_type)
+			if self.use_median:
+				self.median_stack = np.empty((self.n_layers,) + shape, dtype= tile.dtype) #native (uint8) planes
+
+		else:
+			#strict comparison keeps the first occurrence (as np.argmax/np.argmin)
+			if self.use_max:
+				mask = tile_greyscale > self.max_grey
+				np.copyto(self.max_grey, tile_greyscale, where= mask)
+				np.copyto(self.max_val, tile, where= mask[:, :, np.newaxis])
+				self.max_idx[mask] = i
+			if self.use_min:
+				mask = tile_greyscale < self.min_grey
+				np.copyto(self.min_grey, tile_greyscale, where= mask)
+				np.copyto(self.min_val, tile, where= mask[:, :, np.newaxis])
+				self.min_idx[mask] = i
+
+		if self.use_moments: #Welford
+			delta = tile - self.mean
+			self.mean += delta / (i + 1)
+			self.M2 += delta * (tile - self.mean)
+
+		if self.use_median:
+			self.median_stack[i] = tile
+
+		self.count = i + 1
+
+	def result(self):
+		#Same outputs as calculate_statistics
+
+		statistics = {}
+		for sel_stats in self.statistic_list:
 			
-			array_idx = np.indices(tile_idx2.shape)
-			last_dim = tile_idx2[array_idx[0], array_idx[1], array_idx[2]]
-			tile_temp2 = tile_temp[array_idx[0], array_idx[1], array_idx[2], last_dim]				
+			if sel_stats == "mean":
+				tile_temp2 = self.mean.astype(np.float32)
+			elif sel_stats == "std":
+				tile_temp2 = np.sqrt(self.M2 / self.count).astype(np.float32)
+			elif sel_stats == "median":
+				if self.integer_input:
+					tile_temp2 = median_planes(self.median_stack[:self.count])
+				else:
+					tile_temp2 = np.median(self.median_stack[:self.count], axis= 0)
+			elif sel_stats == "max":
+				tile_temp2 = self.max_val
+			elif sel_stats == "min":
+				tile_temp2 = self.min_val
+			elif sel_stats in ["maxIndex", "minIndex"]:
+				tile_idx = self.max_idx if sel_stats == "maxIndex" else self.min_idx
+				idx_type = tile_idx.dtype if self.integer_input else np.float32
+				tile_temp2 = tile_idx[:, :, np.newaxis].astype(idx_type, copy=False) #single channel
+			else:
+				print(f'The statistic selected ({sel_stats}) is not available')
+				continue
+
+			statistics[sel_stats] = tile_temp2
+
+		return statistics
+
+def vips_greyscale(image):
+	#Integer greyscale criterion (channel sum, as greyscale_sum)
+
+	return pyvips.Image.sum(image.bandsplit())
+
+def vips_extreme(images, greyscales, direction, idx_format):
+	#Running max/min of the greyscale (strict comparison keeps the first occurrence, as np.argmax/np.argmin)
+
+	image_best = images[0]
+	grey_best = greyscales[0]
+	idx_best = pyvips.Image.black(images[0].width, images[0].height).cast(idx_format)
+
+	for i in range(1, len(images)):
+		if direction == "max":
+			mask = greyscales[i] > grey_best
+		else:
+			mask = greyscales[i] < grey_best
+		
+		image_best = mask.ifthenelse(images[i], image_best)
+		grey_best = mask.ifthenelse(greyscales[i], grey_best)
+		idx_best = mask.ifthenelse(idx_best.new_from_image(i), idx_best)
+
+	return image_best, idx_best
+
+def vips_statistics(images, statistic_list):
+	#Same statistics as calculate_statistics, as a lazy libvips graph over whole (uint8) angle montages.
+	#Nothing is computed until the output is written (libvips threads and streams the pixels).
+
+	n_layers = len(images)
+	idx_format = "uchar" if index_dtype(n_layers) == np.uint8 else "ushort"
+
+	greyscales = None #shared by max/min and their indexes
+	extremes = {}
+
+	statistics = {}
+	for sel_stats in statistic_list:
+
+		if sel_stats == "mean":
+			tile_temp2 = (pyvips.Image.sum(images) / n_layers).cast("float")
+
+		elif sel_stats == "median":
+			if n_layers == 1:
+				tile_temp2 = images[0].cast("float")
+			elif n_layers % 2:
+				tile_temp2 = images[0].bandrank(images[1:], index= n_layers//2).cast("float")
+			else:
+				rank_low = images[0].bandrank(images[1:], index= n_layers//2 - 1)
+				rank_high = images[0].bandrank(images[1:], index= n_layers//2)
+				tile_temp2 = ((rank_low.cast("ushort") + rank_high) / 2).cast("float")
+
+		elif sel_stats == "std":
+			#exact integer sums (double only for the final division)
+			image_sum = pyvips.Image.sum(images).cast("double")
+			image_sum2 = pyvips.Image.sum([image.cast("uint") * image for image in images]).cast("double")
+			variance = (image_sum2 * n_layers - image_sum * image_sum) / (n_layers * n_layers)
+			tile_temp2 = (variance ** 0.5).cast("float")
+
+		elif sel_stats in ["max", "maxIndex", "min", "minIndex"]:
+
+			if greyscales is None:
+				greyscales = [vips_greyscale(image) for image in images]
+
+			direction = "max" if sel_stats in ["max", "maxIndex"] else "min"
+			if direction not in extremes:
+				extremes[direction] = vips_extreme(images, greyscales, direction, idx_format)
+			image_best, idx_best = extremes[direction]
+
+			if sel_stats in ["maxIndex", "minIndex"]:
+				tile_temp2 = idx_best #single channel
+			else:
+				tile_temp2 = image_best
+
+		else:
+			print(f'The statistic selected ({sel_stats}) is not available')
+			continue
 
-	else:
-		print('The statistic selected is not available')
-	
-	return tile_temp2
\ No newline at end of file
+		statistics[sel_stats] = tile_temp2
+
+	return statistics